@@ -0,0 +1,202 @@
+"""Бенчмарк и регрессионная проверка разбора списка врачей (без сети).
+
+Для каждой фикстуры из bench/fixtures и каждого доступного парсера BeautifulSoup:
+  * сверяет результат parse_listing с эталоном bench/golden/<имя>.json;
+  * меряет скорость разбора (карточек в секунду, медиана повторов);
+  * меряет пиковую память разбора через tracemalloc.
+
+    python bench/bench_parser.py                       # таблица в консоль
+    python bench/bench_parser.py --json out.json       # сохранить результаты для сравнения
+    python bench/bench_parser.py --compare base.json   # разница с прошлым прогоном
+    python bench/bench_parser.py --update-golden       # пересохранить эталоны после намеренных изменений
+
+Код возврата 1, если результат разбора не совпал с эталоном.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+GOLDEN_DIR = os.path.join(BENCH_DIR, "golden")
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, REPO_DIR)
+
+import prodoctorov_parser  # noqa: E402
+
+
+def available_backends():
+    backends = ["html.parser"]
+    try:
+        import lxml  # noqa: F401
+        backends.append("lxml")
+    except ImportError:
+        pass
+    return backends
+
+
+def parse(html, backend):
+    return {
+        "page_count": prodoctorov_parser.parse_page_count(html),
+        "doctors": prodoctorov_parser.parse_doctors(html, backend=backend),
+    }
+
+
+def measure_speed(html, backend, min_seconds, min_repeats):
+    """Медиана времени одного разбора"""
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_repeats or time.perf_counter() - started < min_seconds:
+        t0 = time.perf_counter()
+        prodoctorov_parser.parse_doctors(html, backend=backend)
+        timings.append(time.perf_counter() - t0)
+    return statistics.median(timings), len(timings)
+
+
+def measure_peak_memory(html, backend):
+    tracemalloc.start()
+    try:
+        prodoctorov_parser.parse_doctors(html, backend=backend)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def load_golden(name):
+    path = os.path.join(GOLDEN_DIR, f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_golden(name, result):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with open(os.path.join(GOLDEN_DIR, f"{name}.json"), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+        f.write("\n")
+
+
+def first_difference(expected, actual):
+    if expected["page_count"] != actual["page_count"]:
+        return f"page_count: {expected['page_count']} != {actual['page_count']}"
+    if len(expected["doctors"]) != len(actual["doctors"]):
+        return f"врачей: {len(expected['doctors'])} != {len(actual['doctors'])}"
+    for i, (exp, act) in enumerate(zip(expected["doctors"], actual["doctors"])):
+        for field in sorted(set(exp) | set(act)):
+            if exp.get(field) != act.get(field):
+                return f"врач {i}, поле {field}: {exp.get(field)!r} != {act.get(field)!r}"
+    return None
+
+
+def run(args):
+    fixtures = sorted(f[:-5] for f in os.listdir(FIXTURES_DIR) if f.endswith(".html"))
+    if args.fixture:
+        fixtures = [f for f in fixtures if f in args.fixture]
+    results = []
+    failures = 0
+
+    for name in fixtures:
+        with open(os.path.join(FIXTURES_DIR, f"{name}.html"), "r", encoding="utf-8") as f:
+            html = f.read()
+
+        if args.update_golden:
+            save_golden(name, parse(html, "html.parser"))
+        golden = load_golden(name)
+
+        for backend in available_backends():
+            result = parse(html, backend)
+            if golden is None:
+                status = "нет эталона"
+                failures += 1
+            else:
+                diff = first_difference(golden, result)
+                status = "ok" if diff is None else f"ОТЛИЧИЕ: {diff}"
+                failures += diff is not None
+
+            seconds, repeats = measure_speed(html, backend, args.min_seconds, args.min_repeats)
+            cards = len(result["doctors"])
+            results.append({
+                "fixture": name,
+                "backend": backend,
+                "html_bytes": len(html.encode("utf-8")),
+                "cards": cards,
+                "seconds": seconds,
+                "repeats": repeats,
+                "cards_per_second": cards / seconds if seconds else None,
+                "peak_memory_bytes": measure_peak_memory(html, backend),
+                "golden": status,
+            })
+
+    return results, failures
+
+
+def print_table(results, baseline=None):
+    base = {(r["fixture"], r["backend"]): r for r in (baseline or {}).get("results", [])}
+    header = f"{'фикстура':<16} {'парсер':<12} {'карт.':>6} {'мс':>9} {'карт./с':>10} {'пик, КБ':>9}  эталон"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        line = (
+            f"{r['fixture']:<16} {r['backend']:<12} {r['cards']:>6} {r['seconds'] * 1000:>9.2f} "
+            f"{r['cards_per_second'] or 0:>10.0f} {r['peak_memory_bytes'] / 1024:>9.0f}  {r['golden']}"
+        )
+        prev = base.get((r["fixture"], r["backend"]))
+        if prev:
+            speed = (r["seconds"] / prev["seconds"] - 1) * 100
+            memory = (r["peak_memory_bytes"] / prev["peak_memory_bytes"] - 1) * 100
+            line += f"  [время {speed:+.1f}%, память {memory:+.1f}%]"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--compare", help="сравнить с результатами прошлого прогона (--json)")
+    parser.add_argument("--update-golden", action="store_true", help="пересохранить эталоны")
+    parser.add_argument("--fixture", action="append", help="только указанные фикстуры")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="минимальное время замера на фикстуру")
+    parser.add_argument("--min-repeats", type=int, default=5, help="минимальное число повторов")
+    args = parser.parse_args()
+
+    results, failures = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Сравнение с {baseline.get('revision') or args.compare}")
+    print_table(results, baseline)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+
+    if failures:
+        print(f"\nРезультат разбора не совпал с эталоном: {failures}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+"""Нагрузочный прогон бота целиком, без внешней сети.
+
+Поднимает локальные заглушки Bot API, prodoctorov.ru и YandexGPT (с настраиваемыми
+задержками и долей ошибок), направляет на них бота и прогоняет через настоящий
+Dispatcher (dp.feed_update) сценарии множества пользователей: /start, выбор
+специалиста, листание списка, описание симптомов.
+
+    python bench/load_test.py --users 500 --actions 4
+    python bench/load_test.py --users 200 --llm-latency 2 --llm-error-rate 0.1 --json load.json
+    python bench/load_test.py --listing-fixture large --pages 12   # худший случай: 300 карточек на странице
+
+Отчет: пропускная способность, p50/p95/p99 времени обработки по типам действий,
+число запросов к каждой заглушке и задержка event loop.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Бот читает настройки при импорте: задаем их до import
+os.environ.setdefault("BOT_TOKEN", "123456:LOADtestLOADtestLOADtestLOADtest")
+os.environ.setdefault("YANDEX_FOLDER_ID", "loadtest")
+os.environ.setdefault("YANDEX_API_KEY", "loadtest")
+os.environ["BOT_MODE"] = "polling"
+os.environ["FSM_STORAGE"] = "sqlite"
+os.environ["METRICS_PORT"] = "0"
+sys.path.insert(0, REPO_DIR)
+
+from aiohttp import web  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import mgbot_ii15 as bot_module  # noqa: E402
+
+SYMPTOMS = [
+    "болит горло и температура 38",
+    "сильная головная боль второй день",
+    "болит живот после еды, изжога",
+    "заложен нос, насморк неделю",
+    "болит поясница, отдает в ногу",
+    "сыпь на руках, чешется",
+    "давит в груди при нагрузке",
+    "болит зуб, опухла десна",
+    "кашель и слабость",
+    "болит колено после бега",
+]
+
+LLM_ANSWERS = [
+    "Диагноз: ОРВИ.\nСпециалисты: Терапевт, Лор.",
+    "Диагноз: мигрень.\nСпециалисты: Невролог.",
+    "Диагноз: гастрит.\nСпециалисты: Гастроэнтеролог, Терапевт.",
+    "Диагноз: остеохондроз.\nСпециалисты: Невролог, Травматолог.",
+    "Диагноз: дерматит.\nСпециалисты: Дерматолог.",
+]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def load_listing(fixture, pages=None):
+    """HTML страницы списка из bench/fixtures; pages подменяет число страниц в пагинации"""
+    with open(os.path.join(FIXTURES_DIR, f"{fixture}.html"), "r", encoding="utf-8") as f:
+        html = f.read()
+    if pages:
+        links = "".join(f'<a href="/domodedovo/terapevt/?page={n}">{n}</a>' for n in range(2, pages + 1))
+        html = re.sub(r'<div class="b-pagination">.*?</div>', f'<div class="b-pagination">{links}</div>', html, flags=re.S)
+    return html
+
+
+class Upstreams:
+    """Заглушки внешних сервисов с задержкой и ошибками"""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.calls = Counter()
+        self.errors = Counter()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self.listing_html = load_listing(args.listing_fixture, args.pages)
+        self._runners = []
+
+    async def _delay(self, mean):
+        if mean > 0:
+            await asyncio.sleep(self.rng.expovariate(1 / mean))
+
+    def _fail(self, name, rate):
+        if self.rng.random() < rate:
+            self.errors[name] += 1
+            return True
+        return False
+
+    # --- Bot API ---
+    def _message(self, chat_id, text=None, photo=False):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+        }
+        if photo:
+            file_id = f"photo{next(self._file_ids)}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 90, "height": 90}]
+        else:
+            message["text"] = text or "ok"
+        return message
+
+    async def telegram(self, request):
+        method = request.match_info["method"]
+        name = f"telegram.{method}"
+        self.calls[name] += 1
+        form = await request.post()
+        await self._delay(self.args.tg_latency)
+        if self._fail(name, self.args.tg_error_rate):
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1},
+            })
+        chat_id = form.get("chat_id", "1")
+        lowered = method.lower()
+        if lowered == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "LoadBot", "username": "load_bot"}
+        elif lowered == "sendmediagroup":
+            result = [self._message(chat_id, photo=True) for _ in json.loads(form["media"])]
+        elif lowered == "sendphoto":
+            result = self._message(chat_id, photo=True)
+        elif lowered in ("sendmessage", "editmessagetext", "editmessagecaption"):
+            result = self._message(chat_id, form.get("text"))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # --- prodoctorov.ru ---
+    async def listing(self, request):
+        self.calls["prodoctorov.listing"] += 1
+        await self._delay(self.args.site_latency)
+        if self._fail("prodoctorov.listing", self.args.site_error_rate):
+            return web.Response(status=503)
+        return web.Response(text=self.listing_html, content_type="text/html")
+
+    async def photo(self, request):
+        self.calls["prodoctorov.photo"] += 1
+        return web.Response(body=b"\xff\xd8\xff", content_type="image/jpeg")
+
+    # --- YandexGPT ---
+    async def completion(self, request):
+        self.calls["yandexgpt.completion"] += 1
+        payload = await request.json()
+        await self._delay(self.args.llm_latency)
+        if self._fail("yandexgpt.completion", self.args.llm_error_rate):
+            return web.Response(status=self.rng.choice([429, 500, 503]))
+        text = self.rng.choice(LLM_ANSWERS)
+
+        def chunk(part):
+            return {"result": {"alternatives": [{"message": {"role": "assistant", "text": part}}]}}
+
+        if not payload.get("completionOptions", {}).get("stream"):
+            return web.json_response(chunk(text))
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        for end in range(8, len(text) + 8, 8):
+            await response.write((json.dumps(chunk(text[:end]), ensure_ascii=False) + "\n").encode())
+            await asyncio.sleep(0.02)
+        await response.write_eof()
+        return response
+
+    async def _serve(self, app):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self._runners.append(runner)
+        host, port = runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def start(self):
+        telegram = web.Application(client_max_size=20 * 1024 * 1024)
+        telegram.router.add_post("/bot{token}/{method}", self.telegram)
+        site = web.Application()
+        site.router.add_get("/media/{tail:.*}", self.photo)
+        site.router.add_get("/{city}/{slug}/", self.listing)
+        llm = web.Application()
+        llm.router.add_post("/completion", self.completion)
+        return await self._serve(telegram), await self._serve(site), await self._serve(llm) + "/completion"
+
+    async def stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+
+
+class LoopLagMonitor:
+    """Насколько позже запланированного просыпается корутина — признак блокировки event loop"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class TrafficGenerator:
+    """Пользователи, которые ведут себя примерно как в проде"""
+
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        # Популярность специализаций неравномерная (примерно закон Ципфа)
+        names = list(bot_module.SPECIALIZATIONS)
+        self.spec_names = names
+        self.spec_weights = [1 / (rank + 1) for rank in range(len(names))]
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def message_update(self, user_id, text):
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback_update(self, user_id, data):
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self.message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "Показать других врачей",
+                },
+            },
+        }
+
+    async def feed(self, kind, raw):
+        update = Update.model_validate(raw, context={"bot": bot_module.bot})
+        started = time.perf_counter()
+        try:
+            await bot_module.dp.feed_update(bot_module.bot, update)
+        except Exception as e:
+            self.errors[f"{kind}: {type(e).__name__}"] += 1
+        finally:
+            self.latencies[kind].append(time.perf_counter() - started)
+
+    async def think(self):
+        if self.args.think_time > 0:
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+
+    async def user_session(self, user_id):
+        # Пользователи приходят не одновременно, а в течение ramp-up
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp_up))
+        await self.feed("start", self.message_update(user_id, "/start"))
+        last_spec = None
+        for _ in range(self.args.actions):
+            await self.think()
+            roll = self.rng.random()
+            if roll < self.args.symptom_share:
+                await self.feed("menu", self.message_update(user_id, "Главное меню"))
+                await self.feed("symptoms_button", self.message_update(user_id, "🔴 Описать симптомы"))
+                await self.think()
+                await self.feed("symptoms", self.message_update(user_id, self.rng.choice(SYMPTOMS)))
+            elif last_spec and roll < self.args.symptom_share + self.args.paging_share:
+                slug = bot_module.SPECIALIZATIONS[last_spec]
+                data = f"docs:{bot_module.DEFAULT_CITY}:{slug}:1"
+                await self.feed("next_page", self.callback_update(user_id, data))
+            else:
+                last_spec = self.rng.choices(self.spec_names, self.spec_weights)[0]
+                await self.feed("specialist", self.message_update(user_id, last_spec))
+
+    async def run(self):
+        first_id = 10_000_000
+        await asyncio.gather(*(self.user_session(first_id + i) for i in range(self.args.users)))
+
+
+def point_bot_at(upstreams_urls, workdir):
+    """Перенаправляем бота на заглушки и временные файлы"""
+    telegram_url, site_url, llm_url = upstreams_urls
+    bot_module.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+    bot_module.PRODOCTOROV_URL = site_url
+    bot_module.yandex_client.url = llm_url
+    bot_module.user_store.path = os.path.join(workdir, "users.db")
+    bot_module.doctors_store.path = os.path.join(workdir, "doctors.db")
+    bot_module.dp.storage.path = os.path.join(workdir, "fsm.db")
+    bot_module.interaction_log.path = os.path.join(workdir, "interactions.jsonl")
+    bot_module.PERSISTED_CACHES[:] = [
+        (cache, os.path.join(workdir, os.path.basename(path))) for cache, path in bot_module.PERSISTED_CACHES
+    ]
+
+
+def fmt_ms(value):
+    return "—" if value is None else f"{value * 1000:.0f}"
+
+
+def report(traffic, upstreams, lag, elapsed):
+    total = sum(len(v) for v in traffic.latencies.values())
+    result = {
+        "elapsed_seconds": elapsed,
+        "updates": total,
+        "updates_per_second": total / elapsed if elapsed else None,
+        "handlers": {},
+        "errors": dict(traffic.errors),
+        "upstream_calls": dict(upstreams.calls),
+        "upstream_injected_errors": dict(upstreams.errors),
+        "loop_lag": {
+            "p50": percentile(lag.samples, 0.5),
+            "p99": percentile(lag.samples, 0.99),
+            "max": max(lag.samples, default=None),
+        },
+    }
+    print(f"\nОбновлений: {total} за {elapsed:.1f} с — {result['updates_per_second']:.1f} в секунду\n")
+    print(f"{'действие':<16} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+    for kind, values in sorted(traffic.latencies.items()):
+        stats = {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+            "mean": statistics.mean(values),
+        }
+        result["handlers"][kind] = stats
+        print(f"{kind:<16} {stats['count']:>7} {fmt_ms(stats['p50']):>9} {fmt_ms(stats['p95']):>9} "
+              f"{fmt_ms(stats['p99']):>9} {fmt_ms(stats['max']):>9}")
+
+    print("\nЗапросы к заглушкам (внесенные ошибки):")
+    for name, count in sorted(upstreams.calls.items()):
+        print(f"  {name:<32} {count:>7} ({upstreams.errors[name]})")
+    if traffic.errors:
+        print("\nИсключения в обработке:")
+        for name, count in traffic.errors.most_common():
+            print(f"  {name}: {count}")
+    print(f"\nЗадержка event loop: p50 {fmt_ms(result['loop_lag']['p50'])} мс, "
+          f"p99 {fmt_ms(result['loop_lag']['p99'])} мс, max {fmt_ms(result['loop_lag']['max'])} мс")
+    print("\n" + bot_module.metrics_summary().replace("&gt;", ">"))
+    return result
+
+
+async def main_async(args):
+    # Как в on_startup: воркеры разбора до любых потоков и баз
+    await bot_module.start_parser_pool()
+    rng = random.Random(args.seed)
+    upstreams = Upstreams(args, rng)
+    urls = await upstreams.start()
+    lag = LoopLagMonitor()
+
+    with tempfile.TemporaryDirectory(prefix="mgbot-load-") as workdir:
+        point_bot_at(urls, workdir)
+        writer = asyncio.create_task(bot_module.interaction_log.run())
+        traffic = TrafficGenerator(args, rng)
+        lag.start()
+        started = time.perf_counter()
+        try:
+            await traffic.run()
+        finally:
+            elapsed = time.perf_counter() - started
+            await lag.stop()
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+            await bot_module.interaction_log.flush()
+            # Фоновые обновления кэша, запущенные обработчиками, не ждем
+            await bot_module.close_http_session()
+            await bot_module.bot.session.close()
+            await upstreams.stop()
+            bot_module.shutdown_parser_executor()
+            await bot_module.doctors_cache.flush_store()
+            bot_module.user_store.close()
+            bot_module.doctors_store.close()
+            await bot_module.dp.storage.close()
+
+    result = report(traffic, upstreams, lag, elapsed)
+    result["config"] = vars(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500, help="одновременных пользователей")
+    parser.add_argument("--actions", type=int, default=4, help="действий на пользователя после /start")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="за сколько секунд приходят все пользователи")
+    parser.add_argument("--think-time", type=float, default=1.0, help="средняя пауза между действиями, с")
+    parser.add_argument("--symptom-share", type=float, default=0.3, help="доля действий «описать симптомы»")
+    parser.add_argument("--paging-share", type=float, default=0.2, help="доля листаний списка врачей")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="средняя задержка Bot API, с")
+    parser.add_argument("--tg-error-rate", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--site-latency", type=float, default=0.3, help="средняя задержка prodoctorov.ru, с")
+    parser.add_argument("--listing-fixture", default="listing",
+                        help="фикстура страницы списка из bench/fixtures (listing - 20 карточек, large - 300)")
+    parser.add_argument("--pages", type=int, help="число страниц в пагинации (по умолчанию как в фикстуре)")
+    parser.add_argument("--site-error-rate", type=float, default=0.02, help="доля ответов 503 от prodoctorov.ru")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="средняя задержка YandexGPT, с")
+    parser.add_argument("--llm-error-rate", type=float, default=0.05, help="доля ошибок YandexGPT")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчет в файл")
+    parser.add_argument("--verbose", action="store_true", help="логи бота в консоль")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Генерация HTML-фикстур списка врачей в разметке prodoctorov.ru.
+
+Фикстуры лежат в bench/fixtures и коммитятся в репозиторий; скрипт нужен только,
+чтобы пересоздать их (детерминированно, с фиксированным seed):
+
+    python bench/make_fixtures.py
+"""
+import os
+import random
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+SURNAMES = ["Иванов", "Петрова", "Смирнов", "Кузнецова", "Попов", "Васильева", "Соколов", "Михайлова",
+            "Новиков", "Федорова", "Морозов", "Волкова", "Алексеев", "Лебедева", "Семенов", "Егорова"]
+NAMES = ["Анна Сергеевна", "Иван Петрович", "Ольга Викторовна", "Дмитрий Андреевич",
+         "Елена Николаевна", "Сергей Владимирович", "Мария Игоревна", "Алексей Юрьевич"]
+CLINICS = ["Клиника «Здоровье»", "Медцентр «Гиппократ»", "Городская поликлиника №2",
+           "Клиника семейной медицины", "МЦ «Домодедово-Мед»"]
+STREETS = ["ул. Советская", "Каширское ш.", "ул. Текстильщиков", "ул. Корнеева", "мкр. Северный"]
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html lang="ru"><head><meta charset="utf-8"><title>Терапевты — ПроДокторов</title>
+<link rel="stylesheet" href="/static/app.css"><script src="/static/app.js"></script></head>
+<body><header class="b-header"><nav class="b-header__menu">{menu}</nav></header>
+<main class="b-container"><h1>Лучшие терапевты</h1>
+<div class="b-filters">{filters}</div>
+<div class="b-doctor-list">
+"""
+PAGE_TAIL = """</div>
+<div class="b-pagination">{pagination}</div>
+</main><footer class="b-footer">{footer}</footer>
+<script>window.__STATE__ = {{"items": [{state}]}};</script>
+</body></html>
+"""
+
+
+def doctor_card(rng, i, missing):
+    """Одна карточка; поля из missing не выводятся (так бывает на реальных страницах)"""
+    surname = rng.choice(SURNAMES)
+    parts = [f'<div class="b-doctor-card b-doctor-card_size_l" data-doctor-id="{100000 + i}">']
+    if "photo" not in missing:
+        parts.append(f'<img class="b-profile-card__img" src="/media/photo/{100000 + i}.jpg" alt="">')
+    link_class = "b-doctor-card__name" if "name_link" not in missing else "b-doctor-card__link"
+    parts.append(f'<a class="{link_class}" href="/domodedovo/vrach/{100000 + i}-{i}/">')
+    if "name" not in missing:
+        parts.append(f'<span class="b-doctor-card__name-surname">{surname} {rng.choice(NAMES)}</span>')
+    parts.append("</a>")
+    if "rating" not in missing:
+        width = round(rng.uniform(2.5, 6.4), 2)
+        parts.append(f'<div class="b-stars-rate"><div class="b-stars-rate__progress" style="width: {width}em"></div></div>')
+    if "experience" not in missing:
+        parts.append(
+            '<div class="b-doctor-card__experience">'
+            f'<div class="ui-text ui-text_subtitle-1">Стаж {rng.randint(2, 40)} лет</div></div>'
+        )
+    if "clinic" not in missing:
+        parts.append(
+            '<div class="b-doctor-card__lpu-select"><div class="b-select__trigger">'
+            f'<span class="b-select__trigger-main-text">{rng.choice(CLINICS)}</span>'
+            f'<span class="b-select__trigger-adit-text">{rng.choice(STREETS)}, д. {rng.randint(1, 60)}</span>'
+            "</div></div>"
+        )
+    if "price" not in missing:
+        price = rng.randint(8, 45) * 100
+        if rng.random() < 0.3:
+            parts.append(
+                '<div class="b-doctor-card__tabs-wrapper_club"><fieldset>'
+                f'<div class="ui-text ui-text_subtitle-1">{price}\xa0₽</div></fieldset></div>'
+            )
+        else:
+            parts.append(f'<div class="b-doctor-card__price"><span class="ui-text ui-text_subtitle-1">{price}\xa0₽</span></div>')
+    if "phone" not in missing:
+        phone = f"+7 (496) {rng.randint(100, 999)}-{rng.randint(10, 99)}-{rng.randint(10, 99)}"
+        parts.append(
+            '<div class="b-doctor-card__lpu-phone-container">'
+            f'<a class="b-doctor-card__lpu-phone" href="tel:{phone}">{phone}</a></div>'
+        )
+    # Служебная разметка карточки, которую парсер должен пропускать
+    parts.append('<div class="b-doctor-card__reviews">' + "".join(
+        f'<p class="b-review">Отзыв {n}: все понравилось, врач внимательный.</p>' for n in range(rng.randint(0, 4))
+    ) + "</div>")
+    parts.append("</div>")
+    return "\n".join(parts)
+
+
+def page(rng, cards, pages, missing_rate):
+    fields = ["photo", "name", "name_link", "rating", "experience", "clinic", "price", "phone"]
+    body = []
+    for i in range(cards):
+        missing = {f for f in fields if rng.random() < missing_rate}
+        body.append(doctor_card(rng, i, missing))
+    pagination = "".join(f'<a href="/domodedovo/terapevt/?page={n}">{n}</a>' for n in range(2, pages + 1))
+    return (
+        PAGE_HEAD.format(
+            menu="".join(f'<a href="/section/{n}/">Раздел {n}</a>' for n in range(40)),
+            filters="".join(f'<label><input type="checkbox" name="f{n}"> Фильтр {n}</label>' for n in range(60)),
+        )
+        + "\n".join(body)
+        + PAGE_TAIL.format(
+            pagination=pagination,
+            footer="".join(f'<p>Строка подвала {n}</p>' for n in range(80)),
+            state=",".join(f'{{"id": {n}, "slug": "doctor-{n}"}}' for n in range(cards * 5)),
+        )
+    )
+
+
+FIXTURES = {
+    # имя: (seed, карточек, страниц, доля отсутствующих полей)
+    "small": (1, 5, 1, 0.0),
+    "missing_fields": (2, 20, 3, 0.35),
+    # Как обычная выдача prodoctorov.ru: 20 карточек на странице; по умолчанию ее отдает load_test.py
+    "listing": (4, 20, 4, 0.08),
+    "large": (3, 300, 12, 0.08),
+}
+
+
+def main():
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for name, (seed, cards, pages, missing_rate) in FIXTURES.items():
+        path = os.path.join(FIXTURES_DIR, f"{name}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(page(random.Random(seed), cards, pages, missing_rate))
+        print(f"{path}: {os.path.getsize(path)} байт")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,43 @@
 import asyncio
+import functools
+import glob
+import gzip
 import json
 import os
+import shutil
+import socket
+import hashlib
+import html
+import itertools
+import multiprocessing
+import random
 import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 import logging
 import aiohttp
-from aiogram import Bot, Dispatcher, types, F
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
 from aiogram.types import KeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
-from bs4 import BeautifulSoup
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from aiogram.types import FSInputFile, InputMediaPhoto
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from prodoctorov_parser import get_parser_backend, parse_listing_timed
 
 # ------------------ ЗАГРУЗКА .ENV ------------------
 load_dotenv()
@@ -30,79 +51,721 @@ CHANNEL_URL = "https://t.me/medgid_mo"
 CHANNEL_USERNAME = "@medgid_mo"
 
 # ИСПРАВЛЕНИЕ: Сохраняем файлы в /tmp/ где есть права на запись
-CACHE_FILE = "/tmp/doctors_cache.json"
-USERS_FILE = "/tmp/bot_users.json"
-LOG_FILE = "/tmp/logs.txt"
+CACHE_FILE = "/tmp/doctors_cache.json"   # Старый формат, импортируется в DOCTORS_DB один раз
+DOCTORS_DB = "/tmp/doctors_cache.db"
+LLM_CACHE_FILE = "/tmp/llm_cache.json"
+PHOTO_CACHE_FILE = "/tmp/photo_file_ids.json"
+USERS_FILE = "/tmp/bot_users.json"   # Старый формат, импортируется в USERS_DB один раз
+USERS_DB = "/tmp/bot_users.db"
+FSM_DB = "/tmp/bot_fsm.db"
+START_IMAGE = "start.jpg"
+LOG_FILE = "/tmp/interactions.jsonl"
+LEGACY_LOG_FILE = "/tmp/logs.txt"     # Старый текстовый лог, читается только классификатором
+LOG_MAX_BYTES = 10 * 1024 * 1024      # Ротация по размеру
+LOG_ROTATE_HOURS = 24                 # и по времени
+LOG_BACKUPS = 14                      # Сколько сжатых архивов хранить
+LOG_BATCH_SIZE = 200                  # Записей в одной пачке
+LOG_FLUSH_SECONDS = 2                 # Максимальная задержка записи
+LOG_QUEUE_SIZE = 10000                # Сверх этого записи отбрасываются, бот не ждет диск
 
 CACHE_EXPIRE_HOURS = 3
-MAX_DOCTORS = 5
+CACHE_MAX_ENTRIES = 200                 # Максимум специализаций в памяти
+CACHE_MAX_BYTES = 5 * 1024 * 1024       # Ограничение памяти кэша (~5 МБ JSON)
+CACHE_FLUSH_SECONDS = 60                # Как часто сбрасывать кэш на диск
+CACHE_RECHECK_SECONDS = 60              # Не чаще этого перечитываем с диска запись, которую мог обновить другой процесс
+DOCTORS_DELIVERY = os.getenv("DOCTORS_DELIVERY", "media_group")  # media_group или messages
+CACHE_STALE_HOURS = 24                  # Сколько можно отдавать устаревший кэш, пока он обновляется
+CACHE_REFRESH_AHEAD_MINUTES = 30        # За сколько до истечения обновлять кэш в фоне
+WARMER_INTERVAL_SECONDS = 300           # Период обхода специализаций прогревом
+WARMER_CONCURRENCY = 2                  # Одновременных фоновых загрузок
+WARMER_JITTER_SECONDS = 5               # Случайная задержка перед каждой загрузкой
+WARMER_RECENT_HOURS = 24                # Другие города прогреваем, только если их спрашивали за это время
+PROGRESS_SHOW_DELAY = 0.7               # Быстрые ответы приходят без сообщения о прогрессе
+PROGRESS_MIN_INTERVAL = 1.5             # Минимальный интервал между правками прогресса, сек
+MAX_DOCTORS = 5                  # Врачей на одной странице выдачи
+SCRAPE_MAX_PAGES = 5             # Сколько страниц списка загружать с prodoctorov.ru
+SCRAPE_PAGE_CONCURRENCY = 3      # Параллельных загрузок страниц одной специализации
+SCRAPE_HOST_CONCURRENCY = 4      # Всего параллельных запросов к одному сайту (по всем городам)
 ADMIN_ID = 461119006  # Ваш CHAT_ID
 
+# Рассылки
+BROADCAST_RATE = 28                 # Сообщений в секунду (лимит Telegram ~30)
+BROADCAST_WORKERS = 10              # Параллельных отправок
+BROADCAST_MAX_RETRIES = 3           # Попыток на пользователя при flood-wait
+BROADCAST_PROGRESS_SECONDS = 15     # Как часто обновлять прогресс у админа
+BROADCAST_FAILED_REPORT_LIMIT = 20  # Сколько неудачных отправок показывать в отчете
+BROADCAST_LEASE_SECONDS = 60        # Рассылку без продления аренды дольше этого подхватывает другой процесс
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"  # Владелец аренды рассылки
+
+# Проверка доступности пользователей (/check_users)
+LIVENESS_CONCURRENCY = 10           # Параллельных проверок
+LIVENESS_PAGE_SIZE = 20             # Пользователей на странице отчета
+
+PRODOCTOROV_URL = "https://prodoctorov.ru"
+YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+YANDEX_MODEL_URI = f"gpt://{YANDEX_FOLDER_ID}/yandexgpt/latest"
+YANDEX_STREAM = os.getenv("YANDEX_STREAM", "1") == "1"   # Показывать ответ по мере генерации
+STREAM_EDIT_INTERVAL = 1.0                                # Не чаще одной правки в секунду
+
+# Защита от перегрузки YandexGPT
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))   # Одновременных запросов
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "50"))              # Ожидающих в очереди
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "25"))  # Бюджет на запрос с повторами
+LLM_MAX_RETRIES = 2                 # Повторов на 429/5xx
+LLM_BACKOFF_SECONDS = 0.5           # Базовая задержка повтора (растет вдвое, со случайным разбросом)
+LLM_BREAKER_THRESHOLD = 5           # Неудач подряд до размыкания
+LLM_BREAKER_COOLDOWN = 30           # Секунд до пробного запроса
+LLM_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Кэш ответов YandexGPT по нормализованному тексту симптомов
+LLM_CACHE_TTL_HOURS = 24 * 7
+LLM_CACHE_MAX_ENTRIES = 5000
+LLM_CACHE_MAX_BYTES = 5 * 1024 * 1024
+
+# Локальный классификатор симптомов перед YandexGPT
+# Сначала только shadow: включать "on" после того, как /stats покажет высокое совпадение с LLM
+LOCAL_CLASSIFIER_MODE = os.getenv("LOCAL_CLASSIFIER_MODE", "shadow")   # off, shadow или on
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.75"))
+LOCAL_CLASSIFIER_MIN_EVIDENCE = 2        # Два совпадения или одно сильное
+LOCAL_CLASSIFIER_WHOLE_WORD = 3          # Основы такой длины и короче совпадают только целым словом
+LOCAL_CLASSIFIER_STRONG_STEM = 5         # Совпадение по основе от такой длины считается сильным
+LOCAL_CLASSIFIER_SHADOW_RATE = float(os.getenv("LOCAL_CLASSIFIER_SHADOW_RATE", "0.05"))
+
+# Разбор HTML: "auto" выбирает lxml, если он установлен
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "auto")
+# BeautifulSoup держит GIL: в потоке разбор все равно тормозит event loop, поэтому по умолчанию процессы
+PARSER_POOL = os.getenv("PARSER_POOL", "process")          # process или thread
+PARSER_WORKERS = int(os.getenv("PARSER_WORKERS", "2"))
+# fork без повторного импорта бота; spawn и forkserver в каждом воркере заново выполняют этот файл
+PARSER_START_METHOD = os.getenv(
+    "PARSER_START_METHOD", "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# Общий HTTP-клиент для prodoctorov.ru и YandexGPT
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))                  # Общий таймаут запроса, сек
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))  # Таймаут соединения, сек
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100"))                       # Всего соединений
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "10"))      # Соединений на один хост
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+HTTP_DNS_CACHE_SECONDS = int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))
+
+# Режим работы: polling или webhook (для запуска нескольких экземпляров за балансировщиком)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")             # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                 # По умолчанию выводится из BOT_TOKEN
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))    # Одновременно обрабатываемых апдейтов
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Соединений Telegram к нам
+HEALTH_PATH = "/healthz"
+
+# Метрики в формате Prometheus, слушаем только локально
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))     # 0 — не поднимать сервер метрик
+METRICS_PATH = "/metrics"
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Хранилище состояний FSM: sqlite (по умолчанию) или redis (общий для нескольких экземпляров)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+FSM_STATE_TTL_HOURS = int(os.getenv("FSM_STATE_TTL_HOURS", "48"))   # Неактивные состояния удаляются
+FSM_CLEANUP_SECONDS = 3600                                          # Как часто чистить просроченные
+
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN не найден. Добавь его в переменные окружения или .env")
 if not YANDEX_FOLDER_ID:
     raise ValueError("❌ YANDEX_FOLDER_ID не найден. Добавь его в переменные окружения или .env")
 if not YANDEX_API_KEY:
     raise ValueError("❌ YANDEX_API_KEY не найден. Добавь его в переменные окружения или .env")
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"❌ Неизвестный BOT_MODE: {BOT_MODE} (polling или webhook)")
+if BOT_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    raise ValueError("❌ Для BOT_MODE=webhook нужен WEBHOOK_BASE_URL")
+if not WEBHOOK_SECRET:
+    # Одинаковый у всех экземпляров; Telegram допускает только [A-Za-z0-9_-]
+    WEBHOOK_SECRET = hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
 
 # ------------------ ЛОГИРОВАНИЕ ------------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def log_interaction(user: types.User, user_input: str, bot_response: str):
-    """Записываем взаимодействие в файл"""
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] "
-                    f"{user.full_name} (id={user.id})\n"
-                    f"  ➤ Запрос: {user_input}\n"
-                    f"  ➤ Ответ: {bot_response}\n\n")
-    except Exception as e:
-        logger.error(f"Ошибка записи лога: {e}")
+class InteractionLog:
+    """JSONL-лог запросов: очередь в памяти, запись пачками в отдельном потоке, ротация с gzip"""
+
+    def __init__(self, path, max_bytes, rotate_hours, backups, batch_size, flush_seconds, queue_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_after = timedelta(hours=rotate_hours)
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._pending = []
+        self._started = None  # Время первой записи текущего файла
+        self._lock = threading.Lock()  # flush при остановке может совпасть с записью фонового писателя
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, record: dict):
+        """Не блокирует: запись попадает в очередь"""
+        try:
+            self._queue.put_nowait(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        """Фоновый писатель: пачка уходит на диск по размеру или по таймауту"""
+        while True:
+            self._pending.append(await self._queue.get())
+            deadline = time.monotonic() + self.flush_seconds
+            while len(self._pending) < self.batch_size:
+                try:
+                    line = await asyncio.wait_for(self._queue.get(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+                self._pending.append(line)
+            await self.flush()
+
+    async def flush(self):
+        """Пишем все накопленное; вызывается и при остановке бота"""
+        while not self._queue.empty():
+            self._pending.append(self._queue.get_nowait())
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write_lines, lines)
+            self.written += len(lines)
+        except Exception as e:
+            logger.error(f"Ошибка записи лога: {e}")
+
+    def _write_lines(self, lines):
+        with self._lock:
+            if self._needs_rotation():
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            if self._started is None:
+                self._started = datetime.now()
+
+    def _needs_rotation(self):
+        if not os.path.exists(self.path):
+            return False
+        if self._started is None:
+            self._started = self._first_record_time()
+        return (
+            os.path.getsize(self.path) >= self.max_bytes
+            or datetime.now() - self._started >= self.rotate_after
+        )
+
+    def _first_record_time(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return datetime.fromisoformat(json.loads(f.readline())["ts"])
+        except Exception:
+            return datetime.now()
+
+    def _rotate(self):
+        archive = f"{self.path}.{datetime.now():%Y%m%d-%H%M%S-%f}.gz"
+        with open(self.path, "rb") as src, gzip.open(archive, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(self.path)
+        self._started = None
+        for old in self.archives()[:-self.backups]:
+            os.remove(old)
+        logger.info(f"Лог запросов сжат в {archive}")
+
+    def archives(self):
+        """Сжатые архивы от старых к новым"""
+        return sorted(glob.glob(f"{glob.escape(self.path)}.*.gz"))
+
+    def records(self):
+        """Все записи: архивы, затем текущий файл"""
+        for path in self.archives() + [self.path]:
+            if not os.path.exists(path):
+                continue
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+interaction_log = InteractionLog(
+    LOG_FILE,
+    max_bytes=LOG_MAX_BYTES,
+    rotate_hours=LOG_ROTATE_HOURS,
+    backups=LOG_BACKUPS,
+    batch_size=LOG_BATCH_SIZE,
+    flush_seconds=LOG_FLUSH_SECONDS,
+    queue_size=LOG_QUEUE_SIZE,
+)
+
+def log_interaction(user: types.User, user_input: str, bot_response: str, source: str, latency: float):
+    """Ставим запись о запросе в очередь лога"""
+    interaction_log.write({
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "user_id": user.id,
+        "input": user_input,
+        "response": bot_response,
+        "source": source,
+        "cache_hit": source == "cache",
+        "latency_ms": round(latency * 1000),
+    })
+
+# ------------------ МЕТРИКИ ------------------
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+class MetricCounter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = Counter()  # кортеж меток -> значение
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(labels)} {value}" for labels, value in sorted(self.values.items())]
+        return lines
+
+class MetricHistogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.series = {}  # кортеж меток -> [счетчики по корзинам, сумма, количество]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def quantile(self, q, **labels):
+        """Оценка квантиля по корзинам (верхняя граница корзины)"""
+        series = self.series.get(tuple(sorted(labels.items())))
+        if not series or not series[2]:
+            return None
+        for bound, count in zip(self.buckets, series[0]):
+            if count >= q * series[2]:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class MetricsRegistry:
+    """Минимальный реестр метрик; значения, которые компоненты уже считают сами, читаются при выгрузке"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        metric = MetricCounter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        metric = MetricHistogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, name, help_text, kind, func):
+        """func() -> число или {кортеж меток: число}"""
+        self._collectors.append((name, help_text, kind, func))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for name, help_text, kind, func in self._collectors:
+            try:
+                values = func()
+            except Exception as e:
+                logger.error(f"Ошибка метрики {name}: {e}")
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if isinstance(values, dict):
+                lines += [f"{name}{_format_labels(labels)} {value}" for labels, value in sorted(values.items())]
+            else:
+                lines.append(f"{name} {values}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram("bot_handler_seconds", "Время работы обработчиков апдейтов")
+handler_errors = metrics.counter("bot_handler_errors_total", "Исключения в обработчиках")
+scrape_fetch_seconds = metrics.histogram("bot_scrape_fetch_seconds", "Загрузка одной страницы prodoctorov.ru")
+scrape_parse_seconds = metrics.histogram("bot_scrape_parse_seconds", "Разбор одной страницы списка врачей")
+scrape_parse_wait_seconds = metrics.histogram("bot_scrape_parse_wait_seconds", "Ожидание свободного воркера пула разбора")
+scrape_seconds = metrics.histogram("bot_scrape_seconds", "Полная загрузка специализации (все страницы)")
+scrape_errors = metrics.counter("bot_scrape_errors_total", "Неудачные загрузки страниц")
+llm_seconds = metrics.histogram("bot_llm_request_seconds", "HTTP-запросы к YandexGPT")
+telegram_calls = metrics.counter("bot_telegram_api_calls_total", "Вызовы Bot API")
+telegram_flood_waits = metrics.counter("bot_telegram_flood_waits_total", "Ответы Bot API с RetryAfter")
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки каждого обработчика (внутренний middleware: обработчик уже выбран)"""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечаем активных за день пользователей (внешний middleware апдейтов)"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            daily_stats.touch_user(user.id)
+        return await handler(event, data)
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    """Считаем вызовы Bot API по методам и flood-wait"""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = type(method).__name__
+        telegram_calls.inc(method=api_method)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            telegram_flood_waits.inc(method=api_method)
+            raise
+
+async def handle_metrics(request: web.Request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+# ------------------ HTTP-КЛИЕНТ ------------------
+http_session = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая сессия с пулом keep-alive соединений и кэшем DNS"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 # ------------------ УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ------------------
-def load_users():
-    """Загружаем список пользователей"""
-    try:
-        if os.path.exists(USERS_FILE):
-            with open(USERS_FILE, "r", encoding='utf-8') as f:
-                return json.load(f)
-        return []
-    except Exception as e:
-        logger.error(f"Ошибка загрузки пользователей: {e}")
-        return []
+class UserStore:
+    """Пользователи в SQLite (WAL) с индексом id в памяти"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._ids = set()
+        self._cities = {}
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.open()
+        return self._conn
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " id INTEGER PRIMARY KEY,"
+            " username TEXT NOT NULL DEFAULT '',"
+            " first_name TEXT NOT NULL DEFAULT '',"
+            " last_name TEXT NOT NULL DEFAULT '',"
+            " joined_date TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS daily_stats ("
+            " day TEXT NOT NULL,"
+            " metric TEXT NOT NULL,"
+            " key TEXT NOT NULL DEFAULT '',"
+            " count INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (day, metric, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS active_users ("
+            " day TEXT NOT NULL,"
+            " user_id INTEGER NOT NULL,"
+            " PRIMARY KEY (day, user_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " text TEXT NOT NULL,"
+            " photo_path TEXT,"
+            " photo_file_id TEXT,"
+            " keyboard TEXT,"
+            " cursor INTEGER NOT NULL DEFAULT 0,"  # Все пользователи с id <= cursor обработаны
+            " successful INTEGER NOT NULL DEFAULT 0,"
+            " failed INTEGER NOT NULL DEFAULT 0,"
+            " status TEXT NOT NULL DEFAULT 'running',"
+            " created TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Миграция: статус доступности пользователя для /check_users
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if "status" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN status TEXT")
+        if "last_checked" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN last_checked TEXT")
+        if "city" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN city TEXT")
+        # Миграция: аренда рассылки, чтобы ее не продолжали сразу несколько процессов
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(broadcasts)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+        if "lease_until" not in columns:
+            self._conn.execute("ALTER TABLE broadcasts ADD COLUMN lease_until REAL")
+        self._ids = {row[0] for row in self._conn.execute("SELECT id FROM users")}
+        # Первый запуск с агрегатами: считаем регистрации по дням из уже накопленных пользователей
+        has_joins = self._conn.execute("SELECT 1 FROM daily_stats WHERE metric = 'joins' LIMIT 1").fetchone()
+        if self._ids and not has_joins:
+            self.rebuild_joins()
+        # В памяти держим только тех, кто выбрал город не по умолчанию
+        self._cities = {row[0]: row[1] for row in self._conn.execute(
+            "SELECT id, city FROM users WHERE city IS NOT NULL AND city != ?", (DEFAULT_CITY,)
+        )}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __contains__(self, user_id):
+        if self._conn is None:
+            self.open()
+        return user_id in self._ids
+
+    def __len__(self):
+        if self._conn is None:
+            self.open()
+        return len(self._ids)
+
+    def add(self, user_id, username, first_name, last_name="", joined_date=None) -> bool:
+        """Добавляем пользователя; False, если он уже есть"""
+        if user_id in self:
+            return False
+        self.conn.execute(
+            "INSERT OR IGNORE INTO users (id, username, first_name, last_name, joined_date) VALUES (?, ?, ?, ?, ?)",
+            (user_id, username or "", first_name or "", last_name or "", joined_date or datetime.now().isoformat()),
+        )
+        self._ids.add(user_id)
+        daily_stats.record("joins")
+        return True
+
+    def rebuild_joins(self):
+        """Пересчет дневных регистраций по таблице users (только при миграции и импорте)"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM daily_stats WHERE metric = 'joins'")
+            self.conn.execute(
+                "INSERT INTO daily_stats (day, metric, key, count)"
+                " SELECT substr(joined_date, 1, 10), 'joins', '', COUNT(*) FROM users GROUP BY 1"
+            )
+
+    def get_city(self, user_id):
+        if self._conn is None:
+            self.open()
+        return self._cities.get(user_id, DEFAULT_CITY)
+
+    def set_city(self, user_id, city):
+        self.conn.execute("UPDATE users SET city = ? WHERE id = ?", (city, user_id))
+        if city == DEFAULT_CITY:
+            self._cities.pop(user_id, None)
+        else:
+            self._cities[user_id] = city
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def ids_after(self, cursor, limit=1000):
+        """Следующая порция id пользователей после cursor"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (cursor, limit)
+        )]
+
+    def set_statuses(self, results):
+        """Сохраняем результаты проверки: [(status, last_checked, user_id), ...]"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("UPDATE users SET status = ?, last_checked = ? WHERE id = ?", results)
+
+    def status_summary(self):
+        """Количество пользователей по статусам и время последней проверки"""
+        counts = {row[0]: row[1] for row in self.conn.execute(
+            "SELECT COALESCE(status, 'unknown'), COUNT(*) FROM users GROUP BY 1"
+        )}
+        last_checked = self.conn.execute("SELECT MAX(last_checked) FROM users").fetchone()[0]
+        return counts, last_checked
+
+    def page(self, offset, limit):
+        return [dict(row) for row in self.conn.execute(
+            "SELECT id, username, joined_date, status, last_checked FROM users ORDER BY id LIMIT ? OFFSET ?",
+            (limit, offset),
+        )]
+
+    def import_json(self, json_path):
+        """Одноразовый импорт старого bot_users.json"""
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, "r", encoding='utf-8') as f:
+            users = json.load(f)
+        rows = [
+            (u['id'], u.get('username') or "", u.get('first_name') or "", u.get('last_name') or "",
+             u.get('joined_date') or datetime.now().isoformat())
+            for u in users
+        ]
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO users (id, username, first_name, last_name, joined_date) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._ids.update(row[0] for row in rows)
+        self.rebuild_joins()
+        # Переименовываем файл, чтобы не импортировать его повторно
+        os.replace(json_path, json_path + ".imported")
+        return len(rows)
+
+class DailyStats:
+    """Дневные агрегаты для /stats: счетчики копятся в памяти и периодически дописываются в SQLite,
+    поэтому /stats читает десятки строк, а не всех пользователей"""
+
+    def __init__(self, store: UserStore):
+        self.store = store
+        self._pending = Counter()   # (день, метрика, ключ) -> прирост
+        self._active = set()        # (день, id) еще не записанные
+        self._seen_today = set()    # id, уже отмеченные активными сегодня
+        self._seen_day = None
+
+    @staticmethod
+    def today():
+        return datetime.now().date().isoformat()
+
+    def record(self, metric, key="", amount=1):
+        self._pending[(self.today(), metric, key)] += amount
+
+    def touch_user(self, user_id):
+        """Отмечаем пользователя активным сегодня (повторные вызовы за день ничего не стоят)"""
+        day = self.today()
+        if day != self._seen_day:
+            self._seen_day = day
+            self._seen_today = set()
+        if user_id not in self._seen_today:
+            self._seen_today.add(user_id)
+            self._active.add((day, user_id))
+
+    def flush(self):
+        pending, self._pending = self._pending, Counter()
+        active, self._active = self._active, set()
+        if not pending and not active:
+            return
+        conn = self.store.conn
+        with conn:
+            conn.execute("BEGIN")
+            # После перезапуска пользователь мог уже быть отмечен: считаем только новые строки
+            for day, user_id in active:
+                if conn.execute("INSERT OR IGNORE INTO active_users (day, user_id) VALUES (?, ?)", (day, user_id)).rowcount:
+                    pending[(day, "active", "")] += 1
+            conn.executemany(
+                "INSERT INTO daily_stats (day, metric, key, count) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (day, metric, key) DO UPDATE SET count = count + excluded.count",
+                [(day, metric, key, count) for (day, metric, key), count in pending.items()],
+            )
+            # Отметки активности нужны только за текущий день
+            conn.execute("DELETE FROM active_users WHERE day < ?", ((datetime.now() - timedelta(days=1)).date().isoformat(),))
+
+    def window(self, metric, days=1):
+        """Суммы по ключам за последние days дней (включая еще не записанное)"""
+        since = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+        totals = Counter({
+            key: count for key, count in self.store.conn.execute(
+                "SELECT key, SUM(count) FROM daily_stats WHERE day >= ? AND metric = ? GROUP BY key", (since, metric)
+            )
+        })
+        for (day, pending_metric, key), count in self._pending.items():
+            if pending_metric == metric and day >= since:
+                totals[key] += count
+        return totals
+
+    def total(self, metric, days=1):
+        return sum(self.window(metric, days).values())
+
+user_store = UserStore(USERS_DB)
+daily_stats = DailyStats(user_store)
 
 def save_user(user_id: int, username: str, first_name: str, last_name: str = ""):
-    """Сохраняем пользователя с улучшенным логированием"""
+    """Сохраняем пользователя; проверка по индексу в памяти, запись только для новых"""
     try:
-        users = load_users()
-        
-        # Проверяем, есть ли уже пользователь
-        user_exists = any(user['id'] == user_id for user in users)
-        
-        if not user_exists:
-            new_user = {
-                "id": user_id,
-                "username": username,
-                "first_name": first_name,
-                "last_name": last_name,
-                "joined_date": datetime.now().isoformat()
-            }
-            users.append(new_user)
-            
-            # Пытаемся записать в файл
-            try:
-                with open(USERS_FILE, "w", encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
-                logger.info(f"✅ Пользователь сохранен в файл: {username} (id={user_id})")
-                logger.info(f"✅ Всего пользователей: {len(users)}")
-                return True
-            except Exception as e:
-                logger.error(f"❌ Ошибка записи в файл {USERS_FILE}: {e}")
-                return False
-        else:
+        if user_id in user_store:
             logger.info(f"ℹ️ Пользователь уже существует: {username} (id={user_id})")
             return True
+
+        user_store.add(user_id, username, first_name, last_name)
+        logger.info(f"✅ Пользователь сохранен в базу: {username} (id={user_id})")
+        logger.info(f"✅ Всего пользователей: {len(user_store)}")
+        return True
             
     except Exception as e:
         logger.error(f"❌ Критическая ошибка в save_user: {e}")
@@ -137,7 +800,33 @@ SPECIALIZATIONS = {
     "Фтизиатр": "ftiziatr",
     "Эндоскопист": "endoskopist"
 }
+SPEC_NAMES = {slug: name for name, slug in SPECIALIZATIONS.items()}
+
+# Города Подмосковья: название -> часть URL на prodoctorov.ru
+CITIES = {
+    "Домодедово": "domodedovo",
+    "Подольск": "podolsk",
+    "Видное": "vidnoe",
+    "Люберцы": "lyubercy",
+    "Балашиха": "balashiha",
+    "Химки": "himki",
+    "Мытищи": "mytischi",
+    "Королёв": "korolev",
+    "Одинцово": "odincovo",
+    "Красногорск": "krasnogorsk",
+    "Серпухов": "serpuhov",
+    "Коломна": "kolomna",
+}
+CITY_NAMES = {slug: name for name, slug in CITIES.items()}
+DEFAULT_CITY = "domodedovo"
+# Срок жизни кэша по городам (часы); для остальных — CACHE_EXPIRE_HOURS
+CITY_CACHE_EXPIRE_HOURS = {
+    "domodedovo": CACHE_EXPIRE_HOURS,
+    "serpuhov": 6,
+    "kolomna": 6,
+}
 
+@functools.cache
 def get_main_keyboard():
     builder = ReplyKeyboardBuilder()
     for spec in SPECIALIZATIONS.keys():
@@ -146,66 +835,496 @@ def get_main_keyboard():
     builder.adjust(2)
     return builder.as_markup(resize_keyboard=True)
 
+@functools.cache
 def get_start_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.add(KeyboardButton(text="🔵 Найти специалиста"))
     builder.add(KeyboardButton(text="🔴 Описать симптомы"))
+    builder.add(KeyboardButton(text="🏙 Выбрать город"))
     builder.add(KeyboardButton(text="📢 Перейти в наш канал"))
     builder.add(KeyboardButton(text="📤 Поделиться ботом"))
     builder.adjust(1)
     return builder.as_markup(resize_keyboard=True)
 
+@functools.cache
+def get_cities_keyboard():
+    builder = ReplyKeyboardBuilder()
+    for city_name in CITIES:
+        builder.add(KeyboardButton(text=city_name))
+    builder.add(KeyboardButton(text="Главное меню"))
+    builder.adjust(2)
+    return builder.as_markup(resize_keyboard=True)
+
+@functools.cache
 def get_back_to_menu_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.add(KeyboardButton(text="Главное меню"))
     return builder.as_markup(resize_keyboard=True)
 
-def load_cache():
+class DoctorsStore:
+    """Кэш врачей на диске: SQLite (WAL), одна запись на (город, специализация).
+    Запись каждой пары атомарна, блокировки между процессами берет на себя SQLite"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.open()
+        return self._conn
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS doctors ("
+            " city TEXT NOT NULL,"
+            " slug TEXT NOT NULL,"
+            " cached_time TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " PRIMARY KEY (city, slug))"
+        )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, key):
+        """(время, данные, размер JSON) по ключу "город:специализация" или None"""
+        city, slug = key.split(":", 1)
+        row = self.conn.execute(
+            "SELECT cached_time, data FROM doctors WHERE city = ? AND slug = ?", (city, slug)
+        ).fetchone()
+        if row is None:
+            return None
+        return datetime.fromisoformat(row[0]), json.loads(row[1]), len(row[1])
+
+    def cached_time(self, key):
+        """Только время записи, без чтения самих данных"""
+        city, slug = key.split(":", 1)
+        row = self.conn.execute(
+            "SELECT cached_time FROM doctors WHERE city = ? AND slug = ?", (city, slug)
+        ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def put(self, key, cached_time: datetime, data):
+        city, slug = key.split(":", 1)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO doctors (city, slug, cached_time, data) VALUES (?, ?, ?, ?)",
+            (city, slug, cached_time.isoformat(), json.dumps(data, ensure_ascii=False, separators=(",", ":"))),
+        )
+
+    def delete(self, key):
+        city, slug = key.split(":", 1)
+        self.conn.execute("DELETE FROM doctors WHERE city = ? AND slug = ?", (city, slug))
+
+    def write_many(self, changes):
+        """{key: (время, данные) или None для удаления} одной транзакцией"""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for key, value in changes.items():
+                if value is None:
+                    self.delete(key)
+                else:
+                    self.put(key, *value)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM doctors").fetchone()[0]
+
+    def import_json(self, json_path, migrate=None):
+        """Одноразовый импорт старого doctors_cache.json"""
+        if not os.path.exists(json_path):
+            return 0
+        raw = load_cache(json_path)
+        if migrate:
+            raw = migrate(raw)
+        rows = []
+        for key, entry in raw.items():
+            try:
+                city, slug = key.split(":", 1)
+                datetime.fromisoformat(entry["time"])
+                rows.append((city, slug, entry["time"], json.dumps(entry["data"], ensure_ascii=False, separators=(",", ":"))))
+            except Exception as e:
+                logger.error(f"Пропущена битая запись кэша {key}: {e}")
+        with self.conn:
+            self.conn.execute("BEGIN")
+            # Уже сохраненные в базе записи свежее файла, их не трогаем
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO doctors (city, slug, cached_time, data) VALUES (?, ?, ?, ?)", rows
+            )
+        os.replace(json_path, json_path + ".imported")
+        return len(rows)
+
+def load_cache(path=CACHE_FILE):
     try:
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "r", encoding='utf-8') as f:
+        if os.path.exists(path):
+            with open(path, "r", encoding='utf-8') as f:
                 return json.load(f)
         return {}
     except Exception as e:
-        logger.error(f"Ошибка чтения кэша: {e}")
+        logger.error(f"Ошибка чтения кэша {path}: {e}")
         return {}
 
-def save_cache(cache):
+def save_cache(cache, path=CACHE_FILE):
+    """Пишем во временный файл и подменяем старый: при сбое остается прежняя версия"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
     try:
-        with open(CACHE_FILE, "w", encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
     except Exception as e:
-        logger.error(f"Ошибка сохранения кэша: {e}")
-
-async def get_cached_doctors(spec_slug):
-    cache = load_cache()
-    if spec_slug in cache:
-        cached_time = datetime.fromisoformat(cache[spec_slug]["time"])
-        if datetime.now() - cached_time < timedelta(hours=CACHE_EXPIRE_HOURS):
-            return cache[spec_slug]["data"]
+        logger.error(f"Ошибка сохранения кэша {path}: {e}")
+
+class MemoryCache:
+    """In-memory кэш с TTL, LRU-вытеснением и ограничением по памяти.
+    Со store диск не трогаем в event loop: async-методы читают запись в потоке при промахе,
+    а set/pop ставят изменения в очередь, которую фоновая задача пишет в потоке (write-behind)"""
+
+    def __init__(self, ttl: timedelta, max_entries: int, max_bytes: int, store=None,
+                 recheck_interval: timedelta = timedelta(seconds=CACHE_RECHECK_SECONDS)):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store = store
+        self.recheck_interval = recheck_interval.total_seconds()
+        self._entries = OrderedDict()  # key -> (время, данные, размер)
+        self._bytes = 0
+        self._rechecked = {}           # key -> time.monotonic() последней сверки истекшей записи с диском
+        self._unsaved = {}             # key -> (время, данные) или None (удалить) для записи в store
+        self._writer = None
+        self._store_lock = asyncio.Lock()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def _count(self, entry, ttl):
+        if entry is None or datetime.now() - entry[0] >= ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def get(self, key, ttl: timedelta = None):
+        """Возвращаем свежие данные из памяти или None"""
+        return self._count(self.get_entry(key), ttl or self.ttl)
+
+    async def get_async(self, key, ttl: timedelta = None):
+        """Как get, но со store: промах читаем с диска, истекшую запись сверяем с ним не чаще recheck_interval"""
+        ttl = ttl or self.ttl
+        entry = await self.get_entry_async(key)
+        expired = entry is not None and datetime.now() - entry[0] >= ttl
+        if expired and self.store is not None and self._recheck_due(key):
+            # Другой процесс мог уже обновить запись на диске
+            entry = await self._load(key) or entry
+        return self._count(entry, ttl)
+
+    def get_entry(self, key):
+        """Возвращаем (время, данные) из памяти без проверки TTL или None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    async def get_entry_async(self, key):
+        """get_entry, на промахе памяти читаем store"""
+        entry = self.get_entry(key)
+        if entry is None and self.store is not None:
+            entry = await self._load(key)
+        return entry
+
+    async def peek(self, key):
+        """Время записи или None: не меняет порядок LRU и не поднимает запись с диска в память"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry[0]
+        if self.store is None:
+            return None
+        try:
+            return await asyncio.to_thread(self.store.cached_time, key)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша {key} с диска: {e}")
+            return None
+
+    def _recheck_due(self, key):
+        """Истекшую запись сверяем с диском не чаще recheck_interval, а не на каждое обращение"""
+        now = time.monotonic()
+        if now - self._rechecked.get(key, float("-inf")) < self.recheck_interval:
+            return False
+        self._rechecked[key] = now
+        return True
+
+    async def _load(self, key):
+        """Читаем запись из store в потоке и кладем в память, если она свежее"""
+        try:
+            entry = await asyncio.to_thread(self.store.get, key)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша {key} с диска: {e}")
+            return None
+        if entry is None:
+            return None
+        cached_time, data, size = entry
+        current = self._entries.get(key)
+        if current is not None and current[0] >= cached_time:
+            return current[0], current[1]
+        self._put(key, cached_time, data, size)
+        return cached_time, data
+
+    def _put(self, key, cached_time, data, size):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (cached_time, data, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            evicted_key, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            logger.info(f"Кэш: вытеснена запись {evicted_key}")
+
+    def set(self, key, data, cached_time: datetime = None, mark_dirty: bool = True):
+        """Кладем данные в кэш и вытесняем самые старые записи при переполнении"""
+        cached_time = cached_time or datetime.now()
+        self._put(key, cached_time, data, len(json.dumps(data, ensure_ascii=False)))
+        if mark_dirty and self.store is not None:
+            self._queue_write(key, (cached_time, data))
+        elif mark_dirty:
+            self.dirty = True
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+            self.dirty = True
+        if self.store is not None:
+            self._queue_write(key, None)
+
+    def _queue_write(self, key, value):
+        self._unsaved[key] = value
+        if self._writer is None or self._writer.done():
+            try:
+                self._writer = asyncio.get_running_loop().create_task(self.flush_store())
+            except RuntimeError:
+                pass  # Вне event loop: запишет следующий flush_store
+
+    async def flush_store(self):
+        """Пишем накопленные изменения в store в потоке. Ошибка записи не теряет их и не
+        доходит до того, кто положил данные в кэш: они остаются в очереди до следующей попытки"""
+        async with self._store_lock:
+            while self._unsaved:
+                batch, self._unsaved = self._unsaved, {}
+                try:
+                    await asyncio.to_thread(self.store.write_many, batch)
+                except Exception as e:
+                    logger.error(f"Ошибка записи кэша на диск ({len(batch)} записей): {e}")
+                    for key, value in batch.items():
+                        self._unsaved.setdefault(key, value)
+                    return False
+        return True
+
+    def load(self, raw: dict):
+        """Загружаем записи в формате файла кэша {key: {"time": ..., "data": ...}}"""
+        entries = []
+        for key, entry in raw.items():
+            try:
+                entries.append((datetime.fromisoformat(entry["time"]), key, entry["data"]))
+            except Exception as e:
+                logger.error(f"Пропущена битая запись кэша {key}: {e}")
+        # Самые свежие записи добавляем последними, чтобы они вытеснялись позже
+        for cached_time, key, data in sorted(entries, key=lambda x: x[0]):
+            self.set(key, data, cached_time=cached_time, mark_dirty=False)
+
+    def dump(self) -> dict:
+        """Снимок кэша в формате файла"""
+        return {
+            key: {"time": cached_time.isoformat(), "data": data}
+            for key, (cached_time, data, _) in self._entries.items()
+        }
+
+doctors_store = DoctorsStore(DOCTORS_DB)
+doctors_cache = MemoryCache(
+    ttl=timedelta(hours=CACHE_EXPIRE_HOURS),
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_BYTES,
+    store=doctors_store,
+)
+
+# Счетчик запросов по (город, специализация), по нему прогрев выбирает порядок обновления
+spec_requests = Counter()
+spec_last_requested = {}  # "город:специализация" -> time.monotonic() последнего запроса
+_background_tasks = set()
+
+def doctors_key(city, spec_slug):
+    return f"{city}:{spec_slug}"
+
+def city_ttl(city):
+    return timedelta(hours=CITY_CACHE_EXPIRE_HOURS.get(city, CACHE_EXPIRE_HOURS))
+
+async def get_cached_doctors(city, spec_slug):
+    doctors = await doctors_cache.get_async(doctors_key(city, spec_slug), ttl=city_ttl(city))
+    daily_stats.record("doctors_cache", "hit" if doctors is not None else "miss")
+    return doctors
+
+async def get_stale_doctors(city, spec_slug):
+    """Устаревшие, но еще допустимые данные кэша (stale-while-revalidate)"""
+    entry = await doctors_cache.get_entry_async(doctors_key(city, spec_slug))
+    if entry and datetime.now() - entry[0] < timedelta(hours=CACHE_STALE_HOURS):
+        return entry[1]
     return None
 
-def clean_phone(phone_text):
-    if not phone_text or not isinstance(phone_text, str):
-        return None
-    cleaned = re.sub(r'[^0-9+]', '', phone_text)
-    return cleaned if cleaned else None
+async def needs_refresh(city, spec_slug):
+    """Пора ли обновлять запись: ее нет или она скоро истечет"""
+    # peek, а не get_entry: проверка прогревом не должна вытеснять из памяти то, что читают пользователи
+    cached_time = await doctors_cache.peek(doctors_key(city, spec_slug))
+    if cached_time is None:
+        return True
+    refresh_after = city_ttl(city) - timedelta(minutes=CACHE_REFRESH_AHEAD_MINUTES)
+    return datetime.now() - cached_time >= refresh_after
+
+def migrate_doctors_cache(raw: dict):
+    """Старые записи кэша были только по специализации — относим их к городу по умолчанию"""
+    return {key if ":" in key else doctors_key(DEFAULT_CITY, key): entry for key, entry in raw.items()}
+
+llm_cache = MemoryCache(
+    ttl=timedelta(hours=LLM_CACHE_TTL_HOURS),
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    max_bytes=LLM_CACHE_MAX_BYTES,
+)
+
+# URL фото врача -> file_id в Telegram, чтобы каждое фото скачивалось Telegram один раз
+photo_file_ids = MemoryCache(
+    ttl=timedelta(days=365),
+    max_entries=20000,
+    max_bytes=2 * 1024 * 1024,
+)
+
+# Кэши, которые сохраняются на диск между перезапусками (кэш врачей пишется в doctors_store сразу)
+PERSISTED_CACHES = [
+    (llm_cache, LLM_CACHE_FILE),
+    (photo_file_ids, PHOTO_CACHE_FILE),
+]
+
+async def flush_cache():
+    """Сбрасываем изменившиеся кэши на диск (в отдельном потоке)"""
+    await doctors_cache.flush_store()
+    for cache, path in PERSISTED_CACHES:
+        if not cache.dirty:
+            continue
+        cache.dirty = False
+        await asyncio.to_thread(save_cache, cache.dump(), path)
 
-async def update_progress(progress_msg, percent):
-    try:
-        await progress_msg.edit_text(f"🔍 Поиск врачей... {percent}%")
-    except Exception:
-        pass
+async def cache_flusher():
+    """Фоновая запись кэша и дневной статистики на диск (write-behind)"""
+    while True:
+        await asyncio.sleep(CACHE_FLUSH_SECONDS)
+        try:
+            await flush_cache()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой записи кэша: {e}")
+        try:
+            daily_stats.flush()
+        except Exception as e:
+            logger.error(f"Ошибка записи статистики: {e}")
+
+class ProgressReporter:
+    """Сообщение о прогрессе: появляется с задержкой и правится не чаще min_interval"""
+
+    def __init__(self, chat_id, title="🔍 Поиск врачей...",
+                 show_delay=PROGRESS_SHOW_DELAY, min_interval=PROGRESS_MIN_INTERVAL):
+        self.chat_id = chat_id
+        self.title = title
+        self.show_delay = show_delay
+        self.min_interval = min_interval
+        self.message = None
+        self.percent = 0
+        self.phase = None
+        self._shown = None  # (percent, phase) в отправленном сообщении
+        self._last_edit = 0.0
+        self._lock = asyncio.Lock()
+        self._show_task = None
+        self._edit_task = None
+        self._show_started = False  # Задержка прошла, сообщение уже отправляется
+        self._closed = False
+
+    def start(self):
+        """Показываем сообщение, только если результат не пришел за show_delay"""
+        self._show_task = asyncio.create_task(self._show_later())
+
+    async def _show_later(self):
+        await asyncio.sleep(self.show_delay)
+        self._show_started = True
+        await self._render(force=True)
+
+    def _text(self):
+        text = f"{self.title} {self.percent}%"
+        return f"{text}\n{self.phase}" if self.phase else text
+
+    async def _render(self, force=False):
+        async with self._lock:
+            state = (self.percent, self.phase)
+            now = time.monotonic()
+            if state == self._shown or (not force and now - self._last_edit < self.min_interval):
+                return
+            try:
+                if self.message is None:
+                    self.message = await bot.send_message(self.chat_id, self._text())
+                else:
+                    await self.message.edit_text(self._text())
+                self._shown = state
+                self._last_edit = now
+            except Exception:
+                pass
 
-async def ask_yandex_gpt(symptoms: str):
-    """Запрос к YandexGPT для анализа симптомов"""
-    url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-    headers = {
-        "Authorization": f"Api-Key {YANDEX_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    prompt = f"""
+    async def update(self, percent, phase=None):
+        self.percent = percent
+        self.phase = phase or self.phase
+        # Правку отправляем в фоне, чтобы не тормозить загрузку, общую для всех ожидающих
+        if self.message is not None and not self._closed and not self._lock.locked():
+            self._edit_task = asyncio.create_task(self._render())
+
+    async def _stop(self):
+        """Дожидаемся отправки и правок: отмена уже ушедшего запроса не отменит само сообщение"""
+        self._closed = True
+        if self._show_task and not self._show_started:
+            self._show_task.cancel()
+        tasks = [task for task in (self._show_task, self._edit_task) if task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def fail(self, text):
+        """Заменяем прогресс текстом ошибки"""
+        await self._stop()
+        async with self._lock:
+            try:
+                if self.message is None:
+                    self.message = await bot.send_message(self.chat_id, text)
+                else:
+                    await self.message.edit_text(text)
+            except Exception:
+                pass
+
+    async def finish(self):
+        """Убираем сообщение о прогрессе, если оно было показано"""
+        await self._stop()
+        async with self._lock:
+            if self.message is not None:
+                try:
+                    await self.message.delete()
+                except Exception:
+                    pass
+
+def build_symptoms_prompt(symptoms: str):
+    return f"""
 Ты опытный медицинский консультант. Проанализируй симптомы и предложи наиболее подходящих специалистов из этого списка:
 {", ".join(SPECIALIZATIONS.keys())}
 
@@ -214,253 +1333,967 @@ async def ask_yandex_gpt(symptoms: str):
 
 Симптомы: {symptoms}
 """
-    
+
+# ------------------ КЛИЕНТ YANDEXGPT ------------------
+class LLMError(Exception):
+    """Неудачная попытка запроса к LLM"""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+class LLMUnavailable(Exception):
+    """LLM сейчас недоступен: нужен мгновенный запасной ответ"""
+
+class CircuitBreaker:
+    """closed -> open после серии неудач -> half_open (один пробный запрос) -> closed"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.transitions = Counter()
+        self._probe_in_flight = False
+
+    def _set(self, state):
+        if state != self.state:
+            logger.warning(f"Circuit breaker YandexGPT: {self.state} -> {state}")
+            self.state = state
+            self.transitions[state] += 1
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._set("half_open")
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        self._set("closed")
+
+    def release_probe(self):
+        """Пробный запрос отменен, не дождавшись результата"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self._set("open")
+
+class LLMClient:
+    """Клиент YandexGPT: лимит параллельности, очередь, дедлайн, повторы и circuit breaker"""
+
+    def __init__(self, url, max_concurrency, max_queue, deadline):
+        self.url = url
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+        self.stats = Counter()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    async def complete(self, payload, on_partial=None):
+        """Текст ответа или LLMUnavailable"""
+        self.stats["requests"] += 1
+        if self._waiting >= self.max_queue:
+            self.stats["rejected_queue"] += 1
+            raise LLMUnavailable("очередь запросов переполнена")
+        if not self.breaker.allow():
+            self.stats["rejected_open"] += 1
+            raise LLMUnavailable("сервис временно отключен (circuit breaker)")
+
+        try:
+            async with asyncio.timeout(self.deadline):
+                self._waiting += 1
+                try:
+                    await self._semaphore.acquire()
+                finally:
+                    self._waiting -= 1
+                try:
+                    text = await self._attempts(payload, on_partial)
+                finally:
+                    self._semaphore.release()
+        except TimeoutError:
+            self.stats["timeouts"] += 1
+            self.breaker.record_failure()
+            raise LLMUnavailable("превышено время ожидания")
+        except LLMError as e:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise LLMUnavailable(str(e))
+        except BaseException:
+            # Отмена обработчика: пробный запрос не должен зависнуть в half_open
+            self.breaker.release_probe()
+            raise
+
+        self.stats["success"] += 1
+        self.breaker.record_success()
+        return text
+
+    async def _attempts(self, payload, on_partial):
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                return await self._post(payload, on_partial)
+            except LLMError as e:
+                if not e.retryable or attempt == LLM_MAX_RETRIES:
+                    raise
+                self.stats["retries"] += 1
+                delay = LLM_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"YandexGPT: {e}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+    async def _post(self, payload, on_partial):
+        headers = {
+            "Authorization": f"Api-Key {YANDEX_API_KEY}",
+            "Content-Type": "application/json"
+        }
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with get_http_session().post(self.url, headers=headers, json=payload) as resp:
+                outcome = str(resp.status)
+                if resp.status != 200:
+                    raise LLMError(f"HTTP {resp.status}", retryable=resp.status in LLM_RETRYABLE_STATUSES)
+
+                if on_partial is None:
+                    data = await resp.json()
+                    return data["result"]["alternatives"][0]["message"]["text"]
+
+                # В потоковом режиме приходят JSON-строки, в каждой весь текст на текущий момент
+                text = ""
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    text = data["result"]["alternatives"][0]["message"]["text"]
+                    await on_partial(text)
+                if not text:
+                    raise LLMError("пустой ответ")
+                return text
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise LLMError(f"сетевая ошибка: {e!r}", retryable=True)
+        except (KeyError, IndexError, ValueError) as e:
+            raise LLMError(f"неожиданный ответ: {e!r}")
+        finally:
+            llm_seconds.observe(time.perf_counter() - started, status=outcome)
+
+yandex_client = LLMClient(YANDEX_GPT_URL, LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_DEADLINE_SECONDS)
+
+async def ask_yandex_gpt(symptoms: str, on_partial=None):
+    """Запрос к YandexGPT для анализа симптомов; с on_partial ответ читается потоком"""
     payload = {
-        "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt/latest",
-        "completionOptions": {"stream": False, "temperature": 0.7, "maxTokens": 500},
-        "messages": [{"role": "user", "text": prompt}]
+        "modelUri": YANDEX_MODEL_URI,
+        "completionOptions": {"stream": on_partial is not None, "temperature": 0.7, "maxTokens": 500},
+        "messages": [{"role": "user", "text": build_symptoms_prompt(symptoms)}]
     }
+    return await yandex_client.complete(payload, on_partial=on_partial)
+
+def normalize_symptoms(symptoms: str):
+    """Нормализуем текст, чтобы почти одинаковые запросы попадали в один ключ кэша"""
+    text = symptoms.lower().replace("ё", "е")
+    return " ".join(re.findall(r"[a-zа-я0-9]+", text))
+
+def llm_cache_key(symptoms: str):
+    """Ключ кэша учитывает модель и полный текст промпта"""
+    prompt = build_symptoms_prompt(normalize_symptoms(symptoms))
+    return hashlib.sha256(f"{YANDEX_MODEL_URI}\n{prompt}".encode("utf-8")).hexdigest()
+
+def parse_gpt_response(yandex_response: str):
+    """Разбираем ответ YandexGPT: (диагноз, специалисты, разобран ли ответ по формату)"""
+    diagnosis = "неопределенное состояние"
+    specialists = ["Терапевт"]
+    parsed = False
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload, timeout=30) as resp:
-                if resp.status != 200:
-                    return "Ошибка: Не удалось получить рекомендации."
+        if "Диагноз:" in yandex_response and "Специалисты:" in yandex_response:
+            parts = yandex_response.split("Специалисты:")
+            if len(parts) >= 2:
+                diagnosis_part = parts[0].replace("Диагноз:", "").strip()
+                specialists_part = parts[1].strip()
+                
+                diagnosis = diagnosis_part.split(".")[0] if diagnosis_part else "неопределенное состояние"
                 
-                data = await resp.json()
-                return data["result"]["alternatives"][0]["message"]["text"]
+                specialists = []
+                for spec in SPECIALIZATIONS.keys():
+                    if spec.lower() in specialists_part.lower():
+                        specialists.append(spec)
+                
+                parsed = bool(specialists and diagnosis_part)
+                if not specialists:
+                    specialists = ["Терапевт"]
+        else:
+            for spec in SPECIALIZATIONS.keys():
+                if spec.lower() in yandex_response.lower():
+                    specialists.append(spec)
+            
+            if len(specialists) > 2:
+                specialists = specialists[:2]
                 
     except Exception as e:
-        logger.error(f"Ошибка YandexGPT: {e}")
-        return "Ошибка сервиса."
-
-async def scrape_doctors(specialization_slug, chat_id, max_count=MAX_DOCTORS):
-    base_url = "https://prodoctorov.ru"
-    url = f"{base_url}/domodedovo/{specialization_slug}/"
-    doctors = []
-    progress_msg = None
-
-    try:
-        progress_msg = await bot.send_message(chat_id, "🔍 Поиск врачей... 0%")
-        await update_progress(progress_msg, 10)
+        logger.error(f"Ошибка парсинга ответа YandexGPT: {e}")
+        specialists = ["Терапевт"]
+        parsed = False
+
+    return diagnosis, specialists, parsed
+
+# ------------------ ЛОКАЛЬНЫЙ КЛАССИФИКАТОР СИМПТОМОВ ------------------
+# Основы слов -> специалисты; слово из запроса совпадает, если начинается с основы.
+# Короткие основы ("нос", "ухо") совпадают только целым словом, иначе ловят "носить" и "ухоженный"
+SYMPTOM_KEYWORDS = {
+    "Невролог": ["голов", "мигрен", "онемен", "поясниц", "радикулит", "защемлен", "остеохондроз", "судорог"],
+    "ЛОР": ["горло", "горла", "горле", "насморк", "нос", "носа", "носу", "носом", "ухо", "уха", "уши", "ушах", "ушна", "ушно", "гайморит", "отит", "ангин", "миндалин", "сопл"],
+    "Кардиолог": ["сердц", "сердеч", "давлен", "пульс", "аритми", "тахикарди", "гипертони"],
+    "Офтальмолог": ["глаз", "зрени", "слезят", "конъюнктивит", "веко", "веки"],
+    "Дерматолог": ["сыпь", "зуд", "зуди", "чешет", "кожа", "кожи", "коже", "кожу", "кожн", "прыщ", "экзем", "лишай", "родинк", "бородавк"],
+    "Гинеколог": ["месячн", "менструа", "беремен", "молочниц", "климакс"],
+    "Уролог": ["мочеиспуск", "простат", "цистит", "почк", "потенци"],
+    "Эндокринолог": ["щитовид", "диабет", "сахар", "гормон"],
+    "Пульмонолог": ["кашел", "кашл", "одышк", "бронх", "пневмони", "астм", "мокрот"],
+    "Травматолог": ["перелом", "ушиб", "вывих", "растяжен", "травм"],
+    "Ортопед": ["сустав", "плоскостоп", "сколиоз", "осанк", "колен"],
+    "Флеболог": ["варикоз", "вены", "венах", "венозн", "тромбоз", "тромбофлебит"],
+    "Маммолог": ["маммо", "мастопати"],
+    "Психотерапевт": ["депресс", "панич", "бессонниц"],
+    "Психолог": ["тревог", "стресс", "апати"],
+    "Нарколог": ["алкогол", "запой", "наркот", "похмел"],
+    "Педиатр": ["ребен", "детей", "детск", "малыш", "младен", "грудничок"],
+    "Онколог": ["опухол", "онколог", "новообразован"],
+    "Нутрициолог": ["похуд", "питани", "ожирен", "диет"],
+    "Фтизиатр": ["туберкул"],
+    "Терапевт": ["температур", "простуд", "орви", "грипп", "слабост", "озноб"],
+}
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+class SymptomClassifier:
+    """Быстрый офлайн-подбор специалиста по ключевым словам и статистике из логов"""
+
+    def __init__(self, keywords):
+        self.keywords = [(stem, spec) for spec, stems in keywords.items() for stem in stems]
+        self.learned = {}  # основа слова -> {специалист: вероятность}
+        self.stats = Counter()
+
+    @staticmethod
+    def _stem(token):
+        return token[:6]
+
+    @staticmethod
+    def _legacy_pairs(path):
+        """(запрос, ответ) из старого текстового лога"""
+        if not os.path.exists(path):
+            return
+        user_input = None
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("➤ Запрос:"):
+                    user_input = line[len("➤ Запрос:"):]
+                elif line.startswith("➤ Ответ:") and user_input:
+                    yield user_input, line[len("➤ Ответ:"):]
+                    user_input = None
+
+    def fit_from_logs(self, log: "InteractionLog", legacy_path=None, min_count=3):
+        """Учим веса основ слов по прошлым ответам YandexGPT из лога"""
+        # Учимся только на ответах YandexGPT, а не на собственных
+        pairs_iter = (
+            (record["input"], record["response"])
+            for record in log.records()
+            if record.get("source") == "llm"
+        )
+        counts = {}
+        pairs = 0
+        for user_input, response in itertools.chain(self._legacy_pairs(legacy_path) if legacy_path else (), pairs_iter):
+            _, specialists, parsed = parse_gpt_response(response)
+            if not parsed:
+                continue
+            pairs += 1
+            for stem in {self._stem(t) for t in normalize_symptoms(user_input).split()}:
+                stem_counts = counts.setdefault(stem, Counter())
+                stem_counts.update(specialists)
+                stem_counts["__total__"] += 1
+        self.learned = {
+            stem: {spec: n / stem_counts["__total__"] for spec, n in stem_counts.items() if spec != "__total__"}
+            for stem, stem_counts in counts.items()
+            if stem_counts["__total__"] >= min_count
         }
+        return pairs
+
+    @staticmethod
+    def _match(token, stem):
+        """0 - нет совпадения, 1 - по короткой основе, 2 - целое слово или длинная основа"""
+        if token == stem:
+            return 2
+        if len(stem) <= LOCAL_CLASSIFIER_WHOLE_WORD or not token.startswith(stem):
+            return 0
+        return 2 if len(stem) >= LOCAL_CLASSIFIER_STRONG_STEM else 1
+
+    def predict(self, symptoms):
+        """Возвращаем (специалисты по убыванию веса, уверенность 0..1, доказательность главного)"""
+        scores = Counter()
+        evidence = Counter()
+        for token in normalize_symptoms(symptoms).split():
+            for stem, spec in self.keywords:
+                match = self._match(token, stem)
+                if match:
+                    scores[spec] += 1.0
+                    evidence[spec] += match
+            for spec, weight in self.learned.get(self._stem(token), {}).items():
+                scores[spec] += weight
+                # Выученная основа - слабое совпадение, если почти всегда ведет к этому специалисту
+                if weight >= 0.5:
+                    evidence[spec] += 1
+        total = sum(scores.values())
+        if not total:
+            return [], 0.0, 0
+        ranked = [spec for spec, _ in scores.most_common()]
+        top_score = scores[ranked[0]]
+        # Второго специалиста показываем, только если у него заметный вес
+        specialists = ranked[:1] + [spec for spec in ranked[1:2] if scores[spec] >= top_score / 2]
+        return specialists, top_score / total, evidence[ranked[0]]
+
+    def is_confident(self, confidence, evidence):
+        """Одно совпадение по короткой основе - еще не повод отвечать без LLM"""
+        return confidence >= LOCAL_CLASSIFIER_THRESHOLD and evidence >= LOCAL_CLASSIFIER_MIN_EVIDENCE
+
+    def record_agreement(self, local_specialists, llm_specialists):
+        """Shadow-метрика: совпал ли главный локальный специалист с ответом LLM"""
+        if not local_specialists:
+            return
+        self.stats["shadow_checks"] += 1
+        if local_specialists[0] in llm_specialists:
+            self.stats["agree"] += 1
+        else:
+            self.stats["disagree"] += 1
+
+    def agreement_rate(self):
+        checks = self.stats["shadow_checks"]
+        return self.stats["agree"] / checks if checks else None
+
+symptom_classifier = SymptomClassifier(SYMPTOM_KEYWORDS)
+
+async def analyze_symptoms(symptoms: str, on_partial=None):
+    """Анализ симптомов: (ответ, диагноз, специалисты, источник: cache/local/llm)"""
+    key = llm_cache_key(symptoms)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        diagnosis, specialists, _ = parse_gpt_response(cached)
+        return cached, diagnosis, specialists, "cache"
+
+    local_specialists, confidence, evidence = [], 0.0, 0
+    if LOCAL_CLASSIFIER_MODE != "off":
+        local_specialists, confidence, evidence = symptom_classifier.predict(symptoms)
+        confident = symptom_classifier.is_confident(confidence, evidence)
+        symptom_classifier.stats["confident" if confident else "ambiguous"] += 1
+        # Часть уверенных ответов все равно сверяем с LLM, чтобы видеть качество
+        if (LOCAL_CLASSIFIER_MODE == "on" and confident
+                and random.random() >= LOCAL_CLASSIFIER_SHADOW_RATE):
+            symptom_classifier.stats["answered"] += 1
+            response = f"Локально: {', '.join(local_specialists)} (уверенность {confidence:.2f})"
+            return response, None, local_specialists, "local"
 
-        await update_progress(progress_msg, 20)
-
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(url, headers=headers, timeout=30) as response:
-                    if response.status != 200:
-                        await update_progress(progress_msg, 100)
-                        await progress_msg.edit_text("⚠️ Не удалось загрузить страницу с врачами")
-                        return []
-
-                    html = await response.text()
-                    await update_progress(progress_msg, 40)
+    try:
+        yandex_response = await ask_yandex_gpt(symptoms, on_partial=on_partial)
+    except LLMUnavailable as e:
+        # Мгновенный запасной ответ: локальный подбор или терапевт
+        logger.warning(f"YandexGPT недоступен: {e}")
+        return f"Ошибка: {e}", None, local_specialists or ["Терапевт"], "fallback"
+
+    diagnosis, specialists, parsed = parse_gpt_response(yandex_response)
+    # В кэш попадают только ответы, разобранные по формату
+    if parsed:
+        llm_cache.set(key, yandex_response)
+        symptom_classifier.record_agreement(local_specialists, specialists)
+    return yandex_response, diagnosis, specialists, "llm"
+
+class ScrapeError(Exception):
+    """Ошибка поиска врачей, текст показывается пользователю"""
+
+class SingleFlight:
+    """Объединяем одновременные запросы с одинаковым ключом в один"""
+
+    def __init__(self):
+        self._flights = {}  # key -> (future, слушатели прогресса)
+        self._tasks = set()  # Ссылки на задачи ведущих, чтобы их не собрал GC
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    async def run(self, key, func, listener=None):
+        """Первый вызов выполняет func(notify), остальные ждут тот же результат"""
+        flight = self._flights.get(key)
+        if flight is None:
+            future = asyncio.get_running_loop().create_future()
+            # Исключение забираем сразу, даже если все ожидающие уже отменены
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            flight = self._flights[key] = (future, [])
+            task = asyncio.create_task(self._lead(key, future, func, flight[1]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if listener:
+            flight[1].append(listener)
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(flight[0])
+
+    async def _lead(self, key, future, func, listeners):
+        async def notify(*args):
+            for callback in list(listeners):
+                try:
+                    await callback(*args)
+                except Exception:
+                    pass
 
-            except Exception as e:
-                logger.error(f"Ошибка HTTP запроса: {e}")
-                await update_progress(progress_msg, 100)
-                await progress_msg.edit_text("⚠️ Ошибка подключения")
-                return []
+        try:
+            future.set_result(await func(notify))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self._flights.pop(key, None)
+
+scrape_flight = SingleFlight()
+
+# ------------------ РАЗБОР КАРТОЧЕК ВРАЧЕЙ ------------------
+_parser_executor = None
+
+def get_parser_executor():
+    """Пул для разбора HTML вне event loop"""
+    global _parser_executor
+    if _parser_executor is None:
+        if PARSER_POOL == "process":
+            _parser_executor = ProcessPoolExecutor(
+                max_workers=PARSER_WORKERS, mp_context=multiprocessing.get_context(PARSER_START_METHOD)
+            )
+        else:
+            _parser_executor = ThreadPoolExecutor(max_workers=PARSER_WORKERS)
+        logger.info(f"Парсер: {get_parser_backend(PARSER_BACKEND)}, пул: {PARSER_POOL} x{PARSER_WORKERS}")
+    return _parser_executor
+
+async def start_parser_pool():
+    """Запускаем воркеры разбора при старте, пока в процессе нет фоновых потоков и открытых баз.
+    С fork пул поднимает все процессы при первой задаче - отправляем ее сразу"""
+    loop = asyncio.get_running_loop()
+    backend = await loop.run_in_executor(get_parser_executor(), get_parser_backend, PARSER_BACKEND)
+    logger.info(f"Воркеры разбора запущены, парсер {backend}")
+
+def shutdown_parser_executor():
+    global _parser_executor
+    if _parser_executor is not None:
+        _parser_executor.shutdown(wait=False, cancel_futures=True)
+    _parser_executor = None
+
+async def parse_listing_async(html):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    result, parse_time = await loop.run_in_executor(
+        get_parser_executor(), parse_listing_timed, html, PARSER_BACKEND, PRODOCTOROV_URL
+    )
+    # Сам разбор и очередь к пулу считаем отдельно, иначе под нагрузкой "медленный разбор" - это ожидание
+    scrape_parse_seconds.observe(parse_time)
+    scrape_parse_wait_seconds.observe(max(0.0, time.perf_counter() - started - parse_time))
+    return result
+
+SCRAPE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+}
 
-        await update_progress(progress_msg, 60)
+_host_semaphores = {}
 
-        soup = BeautifulSoup(html, 'html.parser')
-        await update_progress(progress_msg, 70)
-        
-        cards = soup.select('div.b-doctor-card')
-        
-        if not cards:
-            await update_progress(progress_msg, 100)
-            await progress_msg.edit_text("😕 Врачи не найдены")
-            return []
+def get_host_semaphore(url):
+    """Общий лимит параллельных запросов к хосту, чтобы несколько городов не перегружали сайт"""
+    host = urlsplit(url).netloc
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(SCRAPE_HOST_CONCURRENCY)
+    return _host_semaphores[host]
 
-        await update_progress(progress_msg, 80)
-
-        for i, card in enumerate(cards[:max_count]):
-            try:
-                progress = 80 + int((i + 1) / min(len(cards), max_count) * 15)
-                await update_progress(progress_msg, progress)
-                await asyncio.sleep(0.1)
-
-                name_elem = card.select_one('span.b-doctor-card__name-surname')
-                name = name_elem.get_text(strip=True) if name_elem else "Не указано"
-
-                doctor_link = None
-                link_selectors = [
-                    'a.b-doctor-card__name',
-                    'a[href*="/doctor/"]',
-                    'a.b-doctor-card__link',
-                ]
-                
-                for selector in link_selectors:
-                    link_elem = card.select_one(selector)
-                    if link_elem and link_elem.get('href'):
-                        href = link_elem['href']
-                        if href.startswith('/'):
-                            doctor_link = base_url + href
-                        elif href.startswith('http'):
-                            doctor_link = href
-                        break
-                
-                if not doctor_link:
-                    any_link = card.select_one('a[href]')
-                    if any_link and any_link.get('href'):
-                        href = any_link['href']
-                        if href.startswith('/'):
-                            doctor_link = base_url + href
-                        elif href.startswith('http'):
-                            doctor_link = href
-
-                rating_elem = card.select_one('div.b-stars-rate__progress')
-                rating = "0.0"
-                if rating_elem and rating_elem.get('style'):
-                    try:
-                        width_str = rating_elem['style'].replace('width:', '').replace('em', '').strip()
-                        rating = f"{round(float(width_str) / 1.28, 1)}"
-                    except:
-                        pass
+async def fetch_page(url):
+    """HTML одной страницы списка врачей"""
+    try:
+        async with get_host_semaphore(url):
+            with scrape_fetch_seconds.time():
+                async with get_http_session().get(url, headers=SCRAPE_HEADERS) as response:
+                    if response.status != 200:
+                        scrape_errors.inc(reason=f"http_{response.status}")
+                        raise ScrapeError("⚠️ Не удалось загрузить страницу с врачами")
+                    return await response.text()
+    except ScrapeError:
+        raise
+    except Exception as e:
+        scrape_errors.inc(reason="network")
+        logger.error(f"Ошибка HTTP запроса {url}: {e}")
+        raise ScrapeError("⚠️ Ошибка подключения")
 
-                photo_elem = card.select_one('img.b-profile-card__img')
-                photo = None
-                if photo_elem and photo_elem.get('src'):
-                    photo_url = photo_elem['src']
-                    photo = photo_url if photo_url.startswith('http') else base_url + photo_url
-
-                experience_elem = card.select_one('div.b-doctor-card__experience .ui-text_subtitle-1')
-                experience = experience_elem.get_text(strip=True) if experience_elem else "Не указан"
-
-                clinic = "Не указана"
-                address = "Не указан"
-                clinic_container = card.select_one('div.b-doctor-card__lpu-select')
-                if clinic_container:
-                    clinic_elem = clinic_container.select_one('span.b-select__trigger-main-text')
-                    address_elem = clinic_container.select_one('span.b-select__trigger-adit-text')
-                    clinic = clinic_elem.get_text(strip=True) if clinic_elem else "Не указана"
-                    address = address_elem.get_text(strip=True) if address_elem else "Не указан"
-
-                price = "Не указана"
-                price_elems = [
-                    '.b-doctor-card__price .ui-text_subtitle-1',
-                    '.b-doctor-card__tabs-wrapper_club fieldset .ui-text_subtitle-1',
-                ]
-                for selector in price_elems:
-                    price_elem = card.select_one(selector)
-                    if price_elem and price_elem.get_text(strip=True):
-                        price = price_elem.get_text(strip=True).replace(u'\xa0', ' ')
-                        break
+async def fetch_doctors(city, specialization_slug, notify):
+    """Загружаем все страницы списка врачей, полный рейтинг кладем в кэш"""
+    url = f"{PRODOCTOROV_URL}/{city}/{specialization_slug}/"
+    started = time.perf_counter()
 
-                phone = "Не указан"
-                phone_clean = None
-                phone_elems = [
-                    '.b-doctor-card__lpu-phone-container .b-doctor-card__lpu-phone',
-                    '.b-doctor-card__phone .ui-text_subtitle-1',
-                ]
-                for selector in phone_elems:
-                    phone_elem = card.select_one(selector)
-                    if phone_elem and phone_elem.get_text(strip=True):
-                        phone = phone_elem.get_text(strip=True)
-                        phone_clean = clean_phone(phone)
-                        break
+    await notify(10, "Загружаем список врачей")
+    html = await fetch_page(url)
 
-                doctors.append({
-                    'name': name,
-                    'link': doctor_link,
-                    'rating': rating,
-                    'photo': photo,
-                    'experience': experience,
-                    'clinic': clinic,
-                    'address': address,
-                    'price': price,
-                    'phone': phone,
-                    'phone_clean': phone_clean
-                })
+    await notify(40, "Разбираем карточки")
+    doctors, page_count = await parse_listing_async(html)
 
-            except Exception as e:
-                logger.error(f"Ошибка парсинга карточки {i}: {e}")
-                continue
+    if not doctors:
+        raise ScrapeError("😕 Врачи не найдены")
+
+    # Остальные страницы грузим параллельно, но не больше SCRAPE_PAGE_CONCURRENCY сразу
+    page_count = min(page_count, SCRAPE_MAX_PAGES)
+    if page_count > 1:
+        await notify(60, f"Загружаем еще {page_count - 1} стр.")
+        semaphore = asyncio.Semaphore(SCRAPE_PAGE_CONCURRENCY)
+
+        async def fetch_more(page):
+            async with semaphore:
+                try:
+                    page_doctors, _ = await parse_listing_async(await fetch_page(f"{url}?page={page}"))
+                    return page_doctors
+                except ScrapeError as e:
+                    logger.warning(f"Страница {page} для {city}/{specialization_slug} пропущена: {e}")
+                    return []
+
+        for page_doctors in await asyncio.gather(*(fetch_more(page) for page in range(2, page_count + 1))):
+            doctors.extend(page_doctors)
+
+    await notify(95, "Сортируем по рейтингу")
+
+    # Один врач может встретиться на двух страницах, если список сдвинулся во время загрузки
+    unique = {}
+    for doc in doctors:
+        unique.setdefault(doc['link'] or doc['name'], doc)
+    doctors = sorted(unique.values(), key=lambda x: float(x['rating']), reverse=True)
+
+    doctors_cache.set(doctors_key(city, specialization_slug), doctors)
+    scrape_seconds.observe(time.perf_counter() - started)
+    logger.info(f"Найдено {len(doctors)} врачей для {city}/{specialization_slug} ({page_count} стр.)")
+    return doctors
+
+async def refresh_doctors(city, specialization_slug):
+    """Обновляем кэш специализации без сообщений пользователю"""
+    try:
+        return await scrape_flight.run(
+            doctors_key(city, specialization_slug),
+            lambda notify: fetch_doctors(city, specialization_slug, notify),
+        )
+    except ScrapeError as e:
+        logger.warning(f"Фоновое обновление {city}/{specialization_slug} не удалось: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка фонового обновления {city}/{specialization_slug}: {e}")
+    return None
 
-        await update_progress(progress_msg, 95)
-        doctors.sort(key=lambda x: float(x['rating']), reverse=True)
-        await update_progress(progress_msg, 100)
-        await asyncio.sleep(1)
-        
-        if progress_msg:
-            await progress_msg.delete()
+def schedule_refresh(city, specialization_slug):
+    """Запускаем фоновое обновление, если оно еще не идет"""
+    if doctors_key(city, specialization_slug) in scrape_flight:
+        return
+    task = asyncio.create_task(refresh_doctors(city, specialization_slug))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-        logger.info(f"Найдено {len(doctors)} врачей для {specialization_slug}")
-        return doctors
+async def scrape_doctors(city, specialization_slug, chat_id):
+    """Поиск врачей с прогрессом; одновременные запросы одной специализации объединяются"""
+    progress = ProgressReporter(chat_id)
+    progress.start()
 
+    try:
+        doctors = await scrape_flight.run(
+            doctors_key(city, specialization_slug),
+            lambda notify: fetch_doctors(city, specialization_slug, notify),
+            listener=progress.update,
+        )
+    except ScrapeError as e:
+        await progress.fail(str(e))
+        return []
     except Exception as e:
         logger.error(f"Общая ошибка парсинга: {e}")
-        if progress_msg:
-            try:
-                await progress_msg.edit_text("⚠️ Ошибка при поиске врачей")
-            except:
-                pass
+        await progress.fail("⚠️ Ошибка при поиске врачей")
         return []
 
+    await progress.finish()
+    return doctors
+
 # ------------------ FSM ------------------
 class Form(StatesGroup):
     waiting_for_symptoms = State()
     waiting_for_choice = State()
     waiting_for_specialist_choice = State()
+    waiting_for_city = State()
+
+class SQLiteStorage(BaseStorage):
+    """FSM в SQLite: состояние переживает перезапуск, неактивные записи истекают через ttl.
+    Запросы идут в отдельном потоке: пока другой воркер держит блокировку записи, event loop не стоит"""
+
+    def __init__(self, path, ttl: timedelta):
+        self.path = path
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._conn = None
+        # Один поток: запросы к соединению не перемежаются, чтение и запись ключа атомарны
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                " key TEXT PRIMARY KEY,"
+                " state TEXT,"
+                " data TEXT NOT NULL DEFAULT '{}',"
+                " updated REAL NOT NULL)"
+            )
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _row(self, key: StorageKey):
+        row = self.conn.execute(
+            "SELECT state, data, updated FROM fsm WHERE key = ?", (self.key_builder.build(key),)
+        ).fetchone()
+        if row is None or time.time() - row[2] >= self.ttl.total_seconds():
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def _write(self, key: StorageKey, state, data):
+        if state is None and not data:
+            self.conn.execute("DELETE FROM fsm WHERE key = ?", (self.key_builder.build(key),))
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO fsm (key, state, data, updated) VALUES (?, ?, ?, ?)",
+            (self.key_builder.build(key), state, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+
+    def _set_state(self, key: StorageKey, state):
+        _, data = self._row(key)
+        self._write(key, state, data)
+
+    def _set_data(self, key: StorageKey, data):
+        state, _ = self._row(key)
+        self._write(key, state, data)
+
+    def _update_data(self, key: StorageKey, data):
+        state, current = self._row(key)
+        current.update(data)
+        self._write(key, state, current)
+        return current
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        await self._run(self._set_state, key, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._run(self._row, key))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await self._run(self._set_data, key, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        return (await self._run(self._row, key))[1]
+
+    async def update_data(self, key: StorageKey, data):
+        """Чтение и запись одним вызовом в потоке хранилища"""
+        return (await self._run(self._update_data, key, dict(data))).copy()
+
+    def _purge_expired(self):
+        return self.conn.execute(
+            "DELETE FROM fsm WHERE updated < ?", (time.time() - self.ttl.total_seconds(),)
+        ).rowcount
+
+    async def purge_expired(self):
+        """Удаляем просроченные записи, возвращаем их число"""
+        return await self._run(self._purge_expired)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self) -> None:
+        await self._run(self._close)
+
+def create_fsm_storage():
+    ttl = timedelta(hours=FSM_STATE_TTL_HOURS)
+    if FSM_STORAGE == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise ValueError("❌ Для FSM_STORAGE=redis установите пакет redis (pip install redis)")
+        return RedisStorage.from_url(
+            FSM_REDIS_URL,
+            key_builder=DefaultKeyBuilder(with_destiny=True),
+            state_ttl=ttl,
+            data_ttl=ttl,
+        )
+    if FSM_STORAGE != "sqlite":
+        raise ValueError(f"❌ Неизвестный FSM_STORAGE: {FSM_STORAGE} (sqlite или redis)")
+    return SQLiteStorage(FSM_DB, ttl)
+
+async def fsm_cleaner():
+    """Redis сам удаляет просроченное по TTL, SQLite чистим периодически"""
+    while True:
+        try:
+            if isinstance(dp.storage, SQLiteStorage):
+                removed = await dp.storage.purge_expired()
+                if removed:
+                    logger.info(f"FSM: удалено просроченных состояний: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки FSM: {e}")
+        await asyncio.sleep(FSM_CLEANUP_SECONDS)
 
 # ------------------ ОБРАБОТЧИКИ ------------------
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
-
-# ------------------ РАССЫЛКА (ИСПРАВЛЕННАЯ) ------------------
-async def broadcast_message(message_text: str, photo_path: str = None):
-    """Отправка рассылки всем пользователям с детальным логированием"""
-    users = load_users()
-    successful = 0
-    failed = 0
-    failed_users = []
-    
-    logger.info(f"Начинаем рассылку для {len(users)} пользователей")
-    
-    for user in users:
+bot.session.middleware(BotAPIMetricsMiddleware())
+dp = Dispatcher(storage=create_fsm_storage())
+dp.update.outer_middleware(ActivityMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# ------------------ РАССЫЛКА ------------------
+class TokenBucket:
+    """Глобальный ограничитель частоты запросов к Telegram"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Flood-wait: останавливаем все отправки на seconds"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+telegram_limiter = TokenBucket(BROADCAST_RATE)
+
+# Клавиатуры, которые можно приложить к рассылке (храним в базе по имени)
+BROADCAST_KEYBOARDS = {
+    "start": lambda: get_start_keyboard(),
+}
+
+class BroadcastLeaseLost(Exception):
+    """Аренду рассылки забрал другой процесс"""
+
+class BroadcastEngine:
+    """Рассылка пулом воркеров с лимитом Telegram, flood-wait и сохраняемым курсором.
+    Рассылку ведет один процесс: владелец аренды, которую он продлевает при сохранении прогресса"""
+
+    def __init__(self, store, limiter, workers=BROADCAST_WORKERS, owner=INSTANCE_ID):
+        self.store = store
+        self.limiter = limiter
+        self.workers = workers
+        self.owner = owner
+        self.running = set()
+
+    def create(self, text, photo_path=None, keyboard=None):
+        cursor = self.store.conn.execute(
+            "INSERT INTO broadcasts (text, photo_path, keyboard, created, owner, lease_until) VALUES (?, ?, ?, ?, ?, ?)",
+            (text, photo_path, keyboard, datetime.now().isoformat(), self.owner, time.time() + BROADCAST_LEASE_SECONDS),
+        )
+        return cursor.lastrowid
+
+    def claim(self, broadcast_id):
+        """Атомарно забираем рассылку без владельца или с истекшей арендой"""
+        now = time.time()
+        cursor = self.store.conn.execute(
+            "UPDATE broadcasts SET owner = ?, lease_until = ? WHERE id = ? AND status = 'running'"
+            " AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?)",
+            (self.owner, now + BROADCAST_LEASE_SECONDS, broadcast_id, now),
+        )
+        return cursor.rowcount == 1
+
+    def load(self, broadcast_id):
+        row = self.store.conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        return dict(row) if row else None
+
+    def unfinished(self):
+        return [row[0] for row in self.store.conn.execute(
+            "SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id"
+        )]
+
+    def _save(self, b):
+        """Сохраняем прогресс и продлеваем аренду; False, если рассылка уже не наша"""
+        cursor = self.store.conn.execute(
+            "UPDATE broadcasts SET photo_file_id = ?, cursor = ?, successful = ?, failed = ?, status = ?, lease_until = ?"
+            " WHERE id = ? AND owner = ?",
+            (b['photo_file_id'], b['cursor'], b['successful'], b['failed'], b['status'],
+             time.time() + BROADCAST_LEASE_SECONDS, b['id'], self.owner),
+        )
+        return cursor.rowcount == 1
+
+    async def _send(self, user_id, b):
+        keyboard = BROADCAST_KEYBOARDS[b['keyboard']]() if b['keyboard'] else None
+        if b['photo_file_id'] or b['photo_path']:
+            # Файл загружаем один раз, дальше отправляем по file_id
+            photo = b['photo_file_id'] or FSInputFile(b['photo_path'])
+            sent = await bot.send_photo(user_id, photo=photo, caption=b['text'],
+                                        parse_mode="HTML", reply_markup=keyboard)
+            if not b['photo_file_id']:
+                b['photo_file_id'] = sent.photo[-1].file_id
+        else:
+            await bot.send_message(user_id, text=b['text'], parse_mode="HTML", reply_markup=keyboard)
+
+    async def _deliver(self, user_id, b):
+        for attempt in range(BROADCAST_MAX_RETRIES):
+            await self.limiter.acquire()
+            try:
+                await self._send(user_id, b)
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood-wait {e.retry_after} с (пользователь {user_id})")
+                self.limiter.pause(e.retry_after)
+        raise RuntimeError("превышено число попыток после flood-wait")
+
+    async def run(self, broadcast_id, report_chat_id=None):
+        """Выполняем (или продолжаем) рассылку; возвращаем (успешно, ошибок, список ошибок)"""
+        b = self.load(broadcast_id)
+        if b['photo_path'] and not os.path.exists(b['photo_path']):
+            b['photo_path'] = None
+        failed_users = []
+        dispatched = deque()  # id в порядке выдачи воркерам
+        done = set()
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        total = len(self.store)
+        logger.info(f"Рассылка #{broadcast_id}: старт с курсора {b['cursor']}, пользователей {total}")
+
+        def advance_cursor():
+            # Курсор двигаем только по непрерывно обработанному префиксу
+            while dispatched and dispatched[0] in done:
+                done.discard(dispatched[0])
+                b['cursor'] = dispatched.popleft()
+
+        async def handle(user_id):
+            try:
+                await self._deliver(user_id, b)
+                b['successful'] += 1
+            except Exception as e:
+                if not isinstance(e, TelegramForbiddenError):
+                    logger.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+                b['failed'] += 1
+                if len(failed_users) < BROADCAST_FAILED_REPORT_LIMIT:
+                    failed_users.append({"id": user_id, "error": str(e)})
+            done.add(user_id)
+            advance_cursor()
+
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    await handle(user_id)
+                finally:
+                    queue.task_done()
+
+        async def report_progress(progress_msg):
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_SECONDS)
+                if not self._save(b):
+                    raise BroadcastLeaseLost(f"рассылку #{broadcast_id} продолжает другой процесс")
+                if progress_msg:
+                    try:
+                        await progress_msg.edit_text(
+                            f"📤 Рассылка #{broadcast_id}: ✔️ {b['successful']} / ❌ {b['failed']} из {total}"
+                        )
+                    except Exception:
+                        pass
+
+        progress_msg = None
+        if report_chat_id:
+            try:
+                progress_msg = await bot.send_message(report_chat_id, f"📤 Рассылка #{broadcast_id} запущена...")
+            except Exception:
+                pass
+
+        # Фото загружаем на первом получателе, остальным уходит готовый file_id
+        pending_ids = self.store.ids_after(b['cursor'])
+        while pending_ids and b['photo_path'] and not b['photo_file_id']:
+            user_id = pending_ids.pop(0)
+            dispatched.append(user_id)
+            await handle(user_id)
+            if not pending_ids:
+                pending_ids = self.store.ids_after(user_id)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        reporter = asyncio.create_task(report_progress(progress_msg))
+        self.running.add(broadcast_id)
         try:
-            logger.info(f"Пытаемся отправить пользователю {user['username']} (id={user['id']})")
-            
-            if photo_path and os.path.exists(photo_path):
-                with open(photo_path, "rb") as photo:
-                    await bot.send_photo(
-                        chat_id=user['id'],
-                        photo=photo,
-                        caption=message_text,
-                        parse_mode="HTML"
-                    )
-            else:
+            while pending_ids and not reporter.done():
+                for user_id in pending_ids:
+                    if reporter.done():
+                        break
+                    dispatched.append(user_id)
+                    await queue.put(user_id)
+                pending_ids = self.store.ids_after(pending_ids[-1])
+            # Ждем очередь, но прекращаем, как только аренда потеряна
+            joined = asyncio.create_task(queue.join())
+            await asyncio.wait({joined, reporter}, return_when=asyncio.FIRST_COMPLETED)
+            joined.cancel()
+            if reporter.done():
+                reporter.result()
+            b['status'] = 'done'
+        finally:
+            self.running.discard(broadcast_id)
+            for task in workers + [reporter]:
+                task.cancel()
+            self._save(b)
+
+        logger.info(f"Рассылка #{broadcast_id} завершена: ✔️ {b['successful']} / ❌ {b['failed']}")
+        if progress_msg:
+            try:
+                await progress_msg.delete()
+            except Exception:
+                pass
+        return b['successful'], b['failed'], failed_users
+
+broadcast_engine = BroadcastEngine(user_store, telegram_limiter)
+
+async def broadcast_message(message_text: str, photo_path: str = None, keyboard: str = None, report_chat_id=None):
+    """Отправка рассылки всем пользователям через BroadcastEngine"""
+    broadcast_id = broadcast_engine.create(message_text, photo_path, keyboard)
+    return await broadcast_engine.run(broadcast_id, report_chat_id=report_chat_id)
+
+async def resume_broadcasts():
+    """Продолжаем рассылки, брошенные остановленным процессом (аренда не продлевается)"""
+    while True:
+        for broadcast_id in broadcast_engine.unfinished():
+            # Живой процесс продлевает аренду, поэтому забрать получится только брошенную рассылку
+            if broadcast_id in broadcast_engine.running or not broadcast_engine.claim(broadcast_id):
+                continue
+            logger.info(f"Продолжаем рассылку #{broadcast_id}")
+            try:
+                await bot.send_message(ADMIN_ID, f"🔁 Продолжаю прерванную рассылку #{broadcast_id}")
+                successful, failed, _ = await broadcast_engine.run(broadcast_id, report_chat_id=ADMIN_ID)
                 await bot.send_message(
-                    chat_id=user['id'],
-                    text=message_text,
-                    parse_mode="HTML"
+                    ADMIN_ID, f"✅ Рассылка #{broadcast_id} завершена!\n✔️ Успешно: {successful}\n❌ Не удалось: {failed}"
                 )
-            successful += 1
-            logger.info(f"✅ Отправлено пользователю {user['username']}")
-            
-            await asyncio.sleep(0.1)  # Чтобы не спамить Telegram API
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки пользователю {user['id']}: {e}")
-            failed += 1
-            failed_users.append({"id": user['id'], "username": user['username'], "error": str(e)})
-            continue
-    
-    # Детальный отчет об ошибках
-    if failed_users:
-        logger.error("Не удалось отправить следующим пользователям:")
-        for failed_user in failed_users:
-            logger.error(f"  - {failed_user['username']} (id={failed_user['id']}): {failed_user['error']}")
-    
-    return successful, failed, failed_users
+            except BroadcastLeaseLost as e:
+                logger.warning(f"Рассылка #{broadcast_id} остановлена: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка продолжения рассылки #{broadcast_id}: {e}")
+        await asyncio.sleep(BROADCAST_LEASE_SECONDS)
 
 @dp.message(Command("broadcast"))
 async def cmd_broadcast(message: types.Message):
@@ -474,12 +2307,11 @@ async def cmd_broadcast(message: types.Message):
         return
     
     broadcast_text = message.text.split(maxsplit=1)[1]
-    users = load_users()
-    users_count = len(users)
+    users_count = len(user_store)
     
     await message.answer(f"📤 Начинаю рассылку для {users_count} пользователей...")
     
-    successful, failed, failed_users = await broadcast_message(broadcast_text)
+    successful, failed, failed_users = await broadcast_message(broadcast_text, report_chat_id=message.chat.id)
     
     # Детальный отчет
     report = (
@@ -493,37 +2325,125 @@ async def cmd_broadcast(message: types.Message):
     if failed_users:
         report += "\n❌ Не удалось отправить:\n"
         for user in failed_users:
-            report += f"• {user['username']} (id={user['id']})\n"
+            report += f"• id={user['id']}: {user['error'][:80]}\n"
+        if failed > len(failed_users):
+            report += f"… и еще {failed - len(failed_users)}\n"
     
     await message.answer(report)
 
+# ------------------ ПРОВЕРКА ПОЛЬЗОВАТЕЛЕЙ ------------------
+USER_STATUS_LABELS = {
+    "active": "✅ Активен",
+    "blocked": "❌ Заблокировал бота",
+    "error": "⚠️ Ошибка",
+    "unknown": "❔ Не проверен",
+}
+
+liveness_scan_task = None
+
+async def probe_user(user_id):
+    """Незаметная проверка: «печатает...» вместо видимого сообщения"""
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        await telegram_limiter.acquire()
+        try:
+            await bot.send_chat_action(user_id, "typing")
+            return "active"
+        except TelegramRetryAfter as e:
+            telegram_limiter.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception as e:
+            logger.warning(f"Проверка пользователя {user_id} не удалась: {e}")
+            return "error"
+    return "error"
+
+async def scan_users_liveness():
+    """Фоновая проверка всех пользователей, результат сохраняется в базе"""
+    semaphore = asyncio.Semaphore(LIVENESS_CONCURRENCY)
+
+    async def check(user_id):
+        async with semaphore:
+            return await probe_user(user_id), datetime.now().isoformat(), user_id
+
+    checked = 0
+    user_ids = user_store.ids_after(0)
+    while user_ids:
+        results = await asyncio.gather(*(check(user_id) for user_id in user_ids))
+        user_store.set_statuses(results)
+        checked += len(results)
+        user_ids = user_store.ids_after(user_ids[-1])
+    logger.info(f"Проверка пользователей завершена: {checked}")
+    return checked
+
+async def run_liveness_scan(report_chat_id):
+    try:
+        checked = await scan_users_liveness()
+        await bot.send_message(report_chat_id, f"✅ Проверка завершена: {checked} пользователей")
+        text, keyboard = render_users_report(0)
+        await bot.send_message(report_chat_id, text, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Ошибка проверки пользователей: {e}")
+
+def render_users_report(page):
+    """Сводка по сохраненным статусам + одна страница пользователей"""
+    counts, last_checked = user_store.status_summary()
+    total = sum(counts.values())
+    pages = max(1, -(-total // LIVENESS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+
+    report = f"📋 Пользователи: {total}\n"
+    for status, label in USER_STATUS_LABELS.items():
+        if counts.get(status):
+            report += f"{label}: {counts[status]}\n"
+    report += f"🕒 Последняя проверка: {last_checked[:16].replace('T', ' ') if last_checked else 'не было'}\n"
+    report += f"\n📄 Страница {page + 1}/{pages}:\n"
+
+    for user in user_store.page(page * LIVENESS_PAGE_SIZE, LIVENESS_PAGE_SIZE):
+        status = USER_STATUS_LABELS.get(user['status'] or "unknown", user['status'])
+        report += f"👤 {user['username'] or '—'} (id={user['id']}) {status}, с {user['joined_date'][:10]}\n"
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"users_page:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"users_page:{page + 1}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return report, keyboard
+
 @dp.message(Command("check_users"))
 async def cmd_check_users(message: types.Message):
-    """Проверить статус пользователей"""
+    """Статусы пользователей; /check_users scan — запустить фоновую проверку"""
+    global liveness_scan_task
     if message.from_user.id != ADMIN_ID:
         return
-        
-    users = load_users()
-    
-    if not users:
+
+    if not len(user_store):
         await message.answer("📭 В базе нет пользователей")
         return
-    
-    report = "📋 Текущие пользователи:\n\n"
-    
-    for user in users:
-        # Пытаемся отправить test message чтобы проверить доступность
-        try:
-            await bot.send_message(user['id'], "🤖 Проверка связи...")
-            status = "✅ Активен"
-        except Exception as e:
-            status = f"❌ Заблокирован/ошибка: {str(e)}"
-        
-        report += f"👤 {user['username']} (id={user['id']})\n"
-        report += f"   Статус: {status}\n"
-        report += f"   Зарегистрирован: {user['joined_date'][:10]}\n\n"
-    
-    await message.answer(report)
+
+    args = message.text.split()[1:]
+    if args and args[0] == "scan":
+        if liveness_scan_task and not liveness_scan_task.done():
+            await message.answer("⏳ Проверка уже идет")
+            return
+        liveness_scan_task = asyncio.create_task(run_liveness_scan(message.chat.id))
+        await message.answer(f"🔍 Проверяю {len(user_store)} пользователей в фоне...")
+        return
+
+    text, keyboard = render_users_report(0)
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("users_page:"))
+async def handle_users_page(callback: types.CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    text, keyboard = render_users_report(int(callback.data.split(":")[1]))
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except Exception:
+        pass
+    await callback.answer()
 
 @dp.message(Command("stats"))
 async def cmd_stats(message: types.Message):
@@ -532,19 +2452,46 @@ async def cmd_stats(message: types.Message):
         await message.answer("❌ Эта команда только для администратора")
         return
     
-    users = load_users()
-    file_exists = os.path.exists(USERS_FILE)
-    file_size = os.path.getsize(USERS_FILE) if file_exists else 0
+    daily_stats.flush()
+    file_exists = os.path.exists(USERS_DB)
+    file_size = os.path.getsize(USERS_DB) if file_exists else 0
+    
+    def share(counter, keys):
+        total = sum(counter.values())
+        return f"{sum(counter[k] for k in keys) / total:.0%} из {total}" if total else "нет данных"
+
+    def rolling(metric, keys):
+        return f"сутки {share(daily_stats.window(metric, 1), keys)}, 7 дней {share(daily_stats.window(metric, 7), keys)}"
+
+    top_specs = daily_stats.window("spec", 7).most_common(5)
+    top_text = ", ".join(f"{SPEC_NAMES.get(slug, slug)} ({count})" for slug, count in top_specs) or "нет данных"
+    
+    llm_stats = yandex_client.stats
+    agreement_rate = symptom_classifier.agreement_rate()
+    agreement = f"{agreement_rate:.0%} из {symptom_classifier.stats['shadow_checks']}" if agreement_rate is not None else "нет данных"
     
     stats_text = (
         f"📊 Статистика бота:\n"
-        f"👥 Всего пользователей: {len(users)}\n"
-        f"📅 Последние 7 дней: {len([u for u in users if datetime.fromisoformat(u['joined_date']) > datetime.now() - timedelta(days=7)])}\n"
-        f"🆕 Сегодня: {len([u for u in users if datetime.fromisoformat(u['joined_date']).date() == datetime.now().date()])}\n\n"
+        f"👥 Всего пользователей: {len(user_store)}\n"
+        f"📅 Последние 7 дней: {daily_stats.total('joins', 7)}\n"
+        f"🆕 Сегодня: {daily_stats.total('joins', 1)}\n"
+        f"🙋 Активных сегодня: {daily_stats.total('active', 1)}, в среднем за 7 дней: {daily_stats.total('active', 7) / 7:.1f}\n"
+        f"🏆 Популярные за 7 дней: {top_text}\n"
+        f"🧠 Ответы без YandexGPT (кэш/классификатор): {rolling('symptoms', ('cache', 'local'))}\n"
+        f"📦 Кэш врачей, попадания: {rolling('doctors_cache', ('hit',))}\n\n"
         f"🔧 Диагностика:\n"
         f"📁 Файл существует: {'✅' if file_exists else '❌'}\n"
         f"📏 Размер файла: {file_size} байт\n"
-        f"📍 Путь: {USERS_FILE}"
+        f"📍 Путь: {USERS_DB}\n"
+        f"🧠 Кэш YandexGPT: {len(llm_cache)} ответов, попаданий {llm_cache.hits}, промахов {llm_cache.misses}\n"
+        f"🤖 Локальный классификатор ({LOCAL_CLASSIFIER_MODE}): уверенно {symptom_classifier.stats['confident']}, "
+        f"неуверенно {symptom_classifier.stats['ambiguous']}, ответил сам {symptom_classifier.stats['answered']}, "
+        f"согласие с LLM {agreement}\n"
+        f"🛡 YandexGPT: {yandex_client.breaker.state}, запросов {llm_stats['requests']}, успешно {llm_stats['success']}, "
+        f"повторов {llm_stats['retries']}, ошибок {llm_stats['failures']}, таймаутов {llm_stats['timeouts']}, "
+        f"отказов (очередь/breaker) {llm_stats['rejected_queue']}/{llm_stats['rejected_open']}, "
+        f"размыканий breaker {yandex_client.breaker.transitions['open']}\n\n"
+        f"{metrics_summary()}"
     )
     
     await message.answer(stats_text)
@@ -568,10 +2515,8 @@ async def handle_channel_link(message: types.Message):
         reply_markup=keyboard
     )
 
-@dp.message(F.text == "📤 Поделиться ботом")
-async def handle_share_bot(message: types.Message):
-    """Обработчик кнопки поделиться ботом"""
-    bot_username = (await bot.get_me()).username
+@functools.cache
+def get_share_keyboard(bot_username):
     share_text = (
         "🤖 Нашел полезного бота для поиска врачей!\n\n"
         "🔹 Ищет лучших специалистов по рейтингу\n"
@@ -581,10 +2526,16 @@ async def handle_share_bot(message: types.Message):
     )
     
     # Создаем кнопку для легкого шаринга
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📤 Поделиться с друзьями", 
                              url=f"https://t.me/share/url?url=@{bot_username}&text={share_text}")]
     ])
+
+@dp.message(F.text == "📤 Поделиться ботом")
+async def handle_share_bot(message: types.Message):
+    """Обработчик кнопки поделиться ботом"""
+    # bot.me() запрашивает getMe один раз и дальше отдает сохраненный ответ
+    keyboard = get_share_keyboard((await bot.me()).username)
     
     await message.answer(
         "📤 <b>Поделитесь ботом с друзьями!</b>\n\n"
@@ -601,35 +2552,25 @@ async def cmd_force_update(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return
         
-    users = load_users()
-    updated = 0
-    failed = 0
-    
-    for user in users:
-        try:
-            # Отправляем сообщение с новой клавиатурой
-            await bot.send_message(
-                user['id'],
-                "🔄 <b>Бот обновлен!</b>\n\n"
-                "Добавлены новые функции:\n"
-                "• 📢 Перейти в наш канал\n"
-                "• 📤 Поделиться ботом\n\n"
-                "Подписывайтесь на канал МедГид МО - новости медицины Подмосковья!",
-                parse_mode="HTML",
-                reply_markup=get_start_keyboard()
-            )
-            updated += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Ошибка обновления у {user['id']}: {e}")
-            failed += 1
-            continue
+    users_count = len(user_store)
+    await message.answer(f"🔄 Обновляю клавиатуру у {users_count} пользователей...")
+
+    # Отправляем сообщение с новой клавиатурой через общий движок рассылок
+    updated, failed, _ = await broadcast_message(
+        "🔄 <b>Бот обновлен!</b>\n\n"
+        "Добавлены новые функции:\n"
+        "• 📢 Перейти в наш канал\n"
+        "• 📤 Поделиться ботом\n\n"
+        "Подписывайтесь на канал МедГид МО - новости медицины Подмосковья!",
+        keyboard="start",
+        report_chat_id=message.chat.id,
+    )
     
     await message.answer(
         f"✅ Принудительное обновление завершено!\n"
         f"✔️ Обновлено: {updated}\n"
         f"❌ Не удалось: {failed}\n"
-        f"👥 Всего пользователей: {len(users)}"
+        f"👥 Всего пользователей: {users_count}"
     )
 
 # ------------------ ОСНОВНЫЕ ОБРАБОТЧИКИ ------------------
@@ -642,12 +2583,64 @@ async def handle_doctor_choice(message: types.Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state == Form.waiting_for_specialist_choice:
         user_data = await state.get_data()
-        recommended_keyboard = user_data.get('recommended_keyboard')
-        await send_doctors_list(message, spec_slug, spec_name, keyboard_to_keep=recommended_keyboard)
+        recommended = user_data.get('recommended_specialists')
+        keyboard = get_recommended_keyboard(recommended) if recommended else None
+        await send_doctors_list(message, spec_slug, spec_name, keyboard_to_keep=keyboard)
     else:
         await state.clear()
         await send_doctors_list(message, spec_slug, spec_name, keyboard_to_keep=get_back_to_menu_keyboard())
 
+def start_image_key():
+    """Ключ file_id в photo_file_ids; при замене файла картинка загрузится заново"""
+    stat = os.stat(START_IMAGE)
+    return f"file:{START_IMAGE}:{stat.st_size}:{int(stat.st_mtime)}"
+
+def get_start_photo():
+    """file_id картинки /start, файл для загрузки или None, если файла нет"""
+    try:
+        key = start_image_key()
+    except OSError:
+        return None
+    return photo_file_ids.get(key) or FSInputFile(START_IMAGE)
+
+def remember_start_photo(sent_message):
+    if sent_message and sent_message.photo:
+        photo_file_ids.set(start_image_key(), sent_message.photo[-1].file_id)
+
+def forget_start_photo():
+    try:
+        photo_file_ids.pop(start_image_key())
+    except OSError:
+        pass
+
+async def upload_start_photo(bot: Bot):
+    """Загружаем картинку /start один раз (тихо, администратору) и сохраняем file_id"""
+    photo = get_start_photo()
+    if not isinstance(photo, FSInputFile):
+        return
+    sent = await bot.send_photo(ADMIN_ID, photo=photo, disable_notification=True)
+    remember_start_photo(sent)
+    try:
+        await sent.delete()
+    except Exception:
+        pass
+    logger.info(f"Картинка {START_IMAGE} загружена, file_id сохранен")
+
+async def precompute_static(bot: Bot):
+    """Неизменяемое между сообщениями готовим при запуске, а не в обработчиках"""
+    for build in (get_main_keyboard, get_start_keyboard, get_cities_keyboard, get_back_to_menu_keyboard):
+        build()
+    try:
+        me = await bot.me()
+        get_share_keyboard(me.username)
+        logger.info(f"Бот: @{me.username}")
+    except Exception as e:
+        logger.error(f"Не удалось получить данные бота: {e}")
+    try:
+        await upload_start_photo(bot)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить {START_IMAGE}, загрузим при первом /start: {e}")
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
@@ -660,8 +2653,9 @@ async def cmd_start(message: types.Message, state: FSMContext):
         last_name=message.from_user.last_name or ""
     )
     
+    city_name = CITY_NAMES.get(user_store.get_city(message.from_user.id), "Домодедово")
     caption = (
-        "👋 Добро пожаловать в <b>МедГид – Домодедово!</b> 🩺\n\n"
+        f"👋 Добро пожаловать в <b>МедГид – {city_name}!</b> 🩺\n\n"
         "Что я умею:\n"
         "🔹 Найду лучших врачей по рейтингу\n"
         "🔹 Проанализирую симптомы и подскажу специалистов\n"
@@ -670,16 +2664,23 @@ async def cmd_start(message: types.Message, state: FSMContext):
     )
     
     # Явно указываем reply_markup для принудительного обновления
+    photo = get_start_photo()
     try:
-        with open("start.jpg", "rb") as img:
-            await bot.send_photo(
-                message.chat.id, 
-                photo=img, 
-                caption=caption, 
-                parse_mode="HTML", 
-                reply_markup=get_start_keyboard()
-            )
-    except Exception:
+        if photo is None:
+            raise FileNotFoundError(START_IMAGE)
+        sent = await bot.send_photo(
+            message.chat.id, 
+            photo=photo, 
+            caption=caption, 
+            parse_mode="HTML", 
+            reply_markup=get_start_keyboard()
+        )
+        if isinstance(photo, FSInputFile):
+            remember_start_photo(sent)
+    except Exception as e:
+        if isinstance(e, TelegramBadRequest) and isinstance(photo, str):
+            # file_id больше не действителен: при следующем /start загрузим файл заново
+            forget_start_photo()
         await message.answer(
             caption, 
             parse_mode="HTML", 
@@ -697,11 +2698,143 @@ async def handle_find_specialist_choice(message: types.Message, state: FSMContex
     await state.clear()
     await message.answer("Выберите специалиста из списка:", reply_markup=get_main_keyboard())
 
+@dp.message(F.text == "🏙 Выбрать город")
+async def handle_choose_city(message: types.Message, state: FSMContext):
+    await state.set_state(Form.waiting_for_city)
+    current = CITY_NAMES.get(user_store.get_city(message.from_user.id))
+    await message.answer(
+        f"🏙 Сейчас выбран город: <b>{current}</b>\nВыберите город для поиска врачей:",
+        parse_mode="HTML",
+        reply_markup=get_cities_keyboard()
+    )
+
+@dp.message(Form.waiting_for_city, F.text.in_(CITIES.keys()))
+async def handle_city_choice(message: types.Message, state: FSMContext):
+    if message.from_user.id not in user_store:
+        save_user(
+            user_id=message.from_user.id,
+            username=message.from_user.username or "",
+            first_name=message.from_user.first_name,
+            last_name=message.from_user.last_name or ""
+        )
+    user_store.set_city(message.from_user.id, CITIES[message.text])
+    logger.info(f"Пользователь {message.from_user.id} выбрал город {message.text}")
+    await message.answer(f"✅ Город: <b>{message.text}</b>", parse_mode="HTML")
+    await cmd_start(message, state)
+
 @dp.message(Form.waiting_for_choice, F.text == "🔴 Описать симптомы")
 async def handle_describe_symptoms_choice(message: types.Message, state: FSMContext):
     await state.set_state(Form.waiting_for_symptoms)
     await message.answer("✍️ Опишите, что вас беспокоит:", reply_markup=get_back_to_menu_keyboard())
 
+def get_recommended_keyboard(specialists):
+    """Клавиатура рекомендованных специалистов; в FSM храним только их названия"""
+    return _recommended_keyboard(tuple(specialists))
+
+@functools.lru_cache(maxsize=256)
+def _recommended_keyboard(specialists):
+    builder = ReplyKeyboardBuilder()
+    for spec_name in specialists:
+        builder.add(KeyboardButton(text=spec_name))
+    builder.add(KeyboardButton(text="Главное меню"))
+    builder.adjust(2)
+    return builder.as_markup(resize_keyboard=True)
+
+async def send_recommendation(message: types.Message, state: FSMContext, diagnosis, specialists, note=""):
+    """Итоговое сообщение с диагнозом и клавиатурой рекомендованных специалистов"""
+    await state.update_data(recommended_specialists=list(specialists))
+    diagnosis_text = f"<b>Возможный диагноз:</b> {diagnosis}\n\n" if diagnosis else ""
+    await message.answer(
+        f"{note}{diagnosis_text}"
+        f"<b>Рекомендую обратиться к:</b> {', '.join(specialists)}\n\n"
+        f"Нажмите на кнопку, чтобы увидеть список врачей.",
+        parse_mode="HTML",
+        reply_markup=get_recommended_keyboard(specialists)
+    )
+    await state.set_state(Form.waiting_for_specialist_choice)
+
+# Раздел «Специалисты:» закончен, если после него уже есть точка или перевод строки
+SPECIALISTS_SECTION_DONE = re.compile(r"Специалисты:[^\n.]*[\n.]")
+
+class StreamingAnswer:
+    """Показываем ответ YandexGPT по мере генерации, правки не чаще STREAM_EDIT_INTERVAL.
+    update() вызывается из потока LLM и только запоминает текст; все запросы к Telegram
+    идут в отдельной задаче run(), чтобы не занимать слот LLM и не съедать его дедлайн"""
+
+    def __init__(self, message: types.Message, state: FSMContext, status_msg: types.Message):
+        self.message = message
+        self.state = state
+        self.status_msg = status_msg
+        self.recommendation_sent = False
+        self._text = ""
+        self._recommendation = None  # (диагноз, специалисты), как только раздел специалистов разобран
+        self._closed = False
+        self._changed = asyncio.Event()
+        self._urgent = asyncio.Event()   # Рекомендация готова или поток закончился: не ждем интервал правок
+        self._last_edit = 0.0
+        self._shown = None
+        self._task = asyncio.create_task(self.run())
+
+    async def update(self, text):
+        if self._recommendation is not None:
+            return
+        self._text = text
+        # Клавиатуру отправляем, как только раздел со специалистами разобран
+        if SPECIALISTS_SECTION_DONE.search(text):
+            diagnosis, specialists, parsed = parse_gpt_response(text)
+            if parsed:
+                self._recommendation = (diagnosis, specialists)
+                self._urgent.set()
+        self._changed.set()
+
+    async def run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            if self._recommendation is not None:
+                diagnosis, specialists = self._recommendation
+                try:
+                    await send_recommendation(self.message, self.state, diagnosis, specialists)
+                    self.recommendation_sent = True
+                except Exception as e:
+                    # Итог отправит обработчик после ответа LLM
+                    logger.error(f"Ошибка ранней отправки рекомендации: {e}")
+                return
+            if self._closed:
+                return
+            await self._show_partial()
+            delay = self._last_edit + STREAM_EDIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), delay)
+                except TimeoutError:
+                    pass
+
+    async def _show_partial(self):
+        if "Диагноз:" not in self._text:
+            return
+        partial = self._text.split("Специалисты:")[0].split("Диагноз:", 1)[1].strip()
+        if not partial or partial == self._shown:
+            return
+        self._last_edit = time.monotonic()
+        self._shown = partial
+        try:
+            await self.status_msg.edit_text(f"🔍 <b>Возможный диагноз:</b> {html.escape(partial)}…", parse_mode="HTML")
+        except Exception:
+            pass
+
+    async def close(self):
+        """Дожидаемся задачи показа и убираем промежуточное сообщение; True, если итог уже отправлен"""
+        self._closed = True
+        self._urgent.set()
+        self._changed.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        try:
+            await self.status_msg.delete()
+        except Exception:
+            pass
+        return self.recommendation_sent
+
 @dp.message(Form.waiting_for_symptoms)
 async def handle_symptoms(message: types.Message, state: FSMContext):
     symptoms = message.text.strip()
@@ -709,94 +2842,151 @@ async def handle_symptoms(message: types.Message, state: FSMContext):
         await message.answer("Пожалуйста, опишите ваши симптомы.")
         return
         
-    await message.answer("🔍 Анализирую симптомы...")
-    yandex_response = await ask_yandex_gpt(symptoms)
-    log_interaction(message.from_user, symptoms, yandex_response)
-
-    if yandex_response.startswith("Ошибка"):
-        await message.answer(yandex_response, reply_markup=get_back_to_menu_keyboard())
-        await state.clear()
+    status_msg = await message.answer("🔍 Анализирую симптомы...")
+    streaming = StreamingAnswer(message, state, status_msg) if YANDEX_STREAM else None
+    started = time.monotonic()
+    try:
+        yandex_response, diagnosis, specialists, source = await analyze_symptoms(
+            symptoms, on_partial=streaming.update if streaming else None
+        )
+    finally:
+        early_sent = await streaming.close() if streaming else False
+    log_interaction(message.from_user, symptoms, yandex_response, source, time.monotonic() - started)
+    daily_stats.record("symptoms", source)
+    if source == "cache":
+        logger.info(f"Ответ на симптомы из кэша (попаданий: {llm_cache.hits}, промахов: {llm_cache.misses})")
+
+    if early_sent:
         return
 
-    diagnosis = "неопределенное состояние"
-    specialists = ["Терапевт"]
-    
+    note = "⚠️ Сервис анализа симптомов сейчас перегружен, поэтому подсказка упрощенная.\n\n" if source == "fallback" else ""
     try:
-        if "Диагноз:" in yandex_response and "Специалисты:" in yandex_response:
-            parts = yandex_response.split("Специалисты:")
-            if len(parts) >= 2:
-                diagnosis_part = parts[0].replace("Диагноз:", "").strip()
-                specialists_part = parts[1].strip()
-                
-                diagnosis = diagnosis_part.split(".")[0] if diagnosis_part else "неопределенное состояние"
-                
-                specialists = []
-                for spec in SPECIALIZATIONS.keys():
-                    if spec.lower() in specialists_part.lower():
-                        specialists.append(spec)
-                
-                if not specialists:
-                    specialists = ["Терапевт"]
-        else:
-            for spec in SPECIALIZATIONS.keys():
-                if spec.lower() in yandex_response.lower():
-                    specialists.append(spec)
-            
-            if len(specialists) > 2:
-                specialists = specialists[:2]
-                
+        await send_recommendation(message, state, diagnosis, specialists, note=note)
     except Exception as e:
-        logger.error(f"Ошибка парсинга ответа YandexGPT: {e}")
-        specialists = ["Терапевт"]
-
-    recommended_kb = ReplyKeyboardBuilder()
-    for spec_name in specialists:
-        recommended_kb.add(KeyboardButton(text=spec_name))
-    recommended_kb.add(KeyboardButton(text="Главное меню"))
-    recommended_kb.adjust(2)
-
-    await state.update_data(recommended_keyboard=recommended_kb.as_markup(resize_keyboard=True))
-    await message.answer(
-        f"<b>Возможный диагноз:</b> {diagnosis}\n\n"
-        f"<b>Рекомендую обратиться к:</b> {', '.join(specialists)}\n\n"
-        f"Нажмите на кнопку, чтобы увидеть список врачей.",
-        parse_mode="HTML",
-        reply_markup=recommended_kb.as_markup(resize_keyboard=True)
-    )
-    await state.set_state(Form.waiting_for_specialist_choice)
+        logger.error(f"Ошибка отправки рекомендации пользователю {message.from_user.id}: {e}")
 
 @dp.message()
 async def handle_unknown_message(message: types.Message):
     await message.answer("Пожалуйста, используйте кнопки меню для навигации.", reply_markup=get_start_keyboard())
 
 async def send_doctors_list(message, spec_slug, spec_name, keyboard_to_keep=None):
-    doctors = await get_cached_doctors(spec_slug)
-    from_cache = True
+    city = user_store.get_city(message.from_user.id)
+    spec_requests[doctors_key(city, spec_slug)] += 1
+    spec_last_requested[doctors_key(city, spec_slug)] = time.monotonic()
+    daily_stats.record("spec", spec_slug)
+    doctors = await get_cached_doctors(city, spec_slug)
     
     if not doctors:
-        from_cache = False
-        doctors = await scrape_doctors(spec_slug, message.chat.id)
+        # Отдаем устаревший список сразу, а свежий загружаем в фоне
+        doctors = await get_stale_doctors(city, spec_slug)
+        if doctors:
+            schedule_refresh(city, spec_slug)
+        else:
+            doctors = await scrape_doctors(city, spec_slug, message.chat.id)
 
     if not doctors:
         await message.answer(f"😕 Не удалось найти врачей '{spec_name}'.", reply_markup=get_back_to_menu_keyboard())
         return
 
-    if not from_cache and doctors:
-        cache = load_cache()
-        cache[spec_slug] = {
-            "time": datetime.now().isoformat(),
-            "data": doctors
-        }
-        save_cache(cache)
+    await deliver_doctors(message, doctors, city, spec_slug, reply_keyboard=keyboard_to_keep or get_back_to_menu_keyboard())
 
-    await message.answer(f"⭐ <b>Врачи {spec_name}</b>", parse_mode="HTML")
+@dp.callback_query(F.data.startswith("docs:"))
+async def handle_doctors_page(callback: types.CallbackQuery):
+    """Листание списка врачей: только из кэша, без загрузки с сайта"""
+    _, city, spec_slug, page = callback.data.split(":")
+    doctors = await get_cached_doctors(city, spec_slug) or await get_stale_doctors(city, spec_slug)
+    if not doctors:
+        await callback.answer("Список устарел — выберите специалиста заново", show_alert=True)
+        return
+    await callback.answer()
+    await deliver_doctors(callback.message, doctors, city, spec_slug, page=int(page))
 
-    for idx, doc in enumerate(doctors, 1):
-        if doc.get('phone_clean'):
-            phone_text = f'<a href="tel:{doc["phone_clean"]}">{doc["phone"]}</a>'
-        else:
-            phone_text = doc['phone']
+def format_doctor_caption(idx, doc):
+    if doc.get('phone_clean'):
+        phone_text = f'<a href="tel:{doc["phone_clean"]}">{doc["phone"]}</a>'
+    else:
+        phone_text = doc['phone']
+
+    return (
+        f"<b>{idx}. {doc['name']}</b> (⭐ {doc['rating']})\n"
+        f"📅 Стаж: {doc['experience']}\n"
+        f"🏥 Клиника: {doc['clinic']}\n"
+        f"📍 Адрес: {doc['address']}\n"
+        f"💰 Приём: {doc['price']}\n"
+        f"📞 Телефон: {phone_text}"
+    )
+
+def remember_photo(url, sent_message):
+    """Запоминаем file_id загруженного Telegram фото"""
+    if url and sent_message and sent_message.photo and photo_file_ids.get(url) is None:
+        photo_file_ids.set(url, sent_message.photo[-1].file_id)
+
+def doctors_nav_row(city, spec_slug, page, pages):
+    """Кнопки листания страниц списка врачей"""
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"docs:{city}:{spec_slug}:{page - 1}"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton(text="Еще врачи ➡️", callback_data=f"docs:{city}:{spec_slug}:{page + 1}"))
+    return row
+
+async def deliver_doctors(message, doctors, city, spec_slug, page=0, reply_keyboard=None):
+    """Отправляем страницу списка врачей: альбомом, если возможно, иначе по одному"""
+    spec_name = SPEC_NAMES.get(spec_slug, spec_slug)
+    pages = max(1, -(-len(doctors) // MAX_DOCTORS))
+    page = min(max(page, 0), pages - 1)
+    numbered = list(enumerate(doctors[page * MAX_DOCTORS:(page + 1) * MAX_DOCTORS], page * MAX_DOCTORS + 1))
+    header = f"⭐ <b>Врачи {spec_name}</b>, {CITY_NAMES.get(city, city)}" + (f" (стр. {page + 1} из {pages})" if pages > 1 else "")
+    nav_row = doctors_nav_row(city, spec_slug, page, pages)
+
+    with_photo = [(idx, doc) for idx, doc in numbered if doc.get('photo')]
+    as_album = DOCTORS_DELIVERY == "media_group" and len(with_photo) >= 2
+    # Заголовок отправляем один раз: если альбом не уйдет, запасной путь его не повторяет.
+    # По одному клавиатура придет с итоговым сообщением, а у альбома его нет - она идет с заголовком
+    await message.answer(header, parse_mode="HTML", reply_markup=reply_keyboard if as_album else None)
+    if as_album:
+        try:
+            await deliver_doctors_album(message, numbered, with_photo, nav_row)
+            return
+        except Exception as e:
+            logger.error(f"Ошибка отправки альбома, отправляем по одному: {e}")
+            # Возможно, устарел один из file_id — повторно их не используем
+            for _, doc in with_photo:
+                photo_file_ids.pop(doc['photo'])
+    await deliver_doctors_messages(message, numbered, nav_row, reply_keyboard)
+
+async def deliver_doctors_album(message, numbered, with_photo, nav_row):
+    """Альбом с подписями + одно сообщение с кнопками карточек (вместе с заголовком 3 запроса)"""
+    # В альбоме не бывает inline-кнопок, поэтому кнопки всех врачей собраны в одном сообщении
+    media = [
+        InputMediaPhoto(
+            media=photo_file_ids.get(doc['photo']) or doc['photo'],
+            caption=format_doctor_caption(idx, doc),
+            parse_mode="HTML",
+        )
+        for idx, doc in with_photo
+    ]
+    sent = await bot.send_media_group(message.chat.id, media=media)
+    for (_, doc), sent_message in zip(with_photo, sent):
+        remember_photo(doc['photo'], sent_message)
+
+    # Врачи без фото не попадают в альбом — их карточки идут текстом
+    text = "\n\n".join(format_doctor_caption(idx, doc) for idx, doc in numbered if not doc.get('photo'))
+    buttons = [
+        [InlineKeyboardButton(text=f"📋 {idx}. {doc['name']}", web_app=types.WebAppInfo(url=doc['link']))]
+        for idx, doc in numbered if doc.get('link')
+    ]
+    if nav_row:
+        buttons.append(nav_row)
+    await message.answer(
+        (text + "\n\n" if text else "") + "✅ Готово! Нажмите на врача, чтобы открыть его карточку.",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None,
+    )
 
+async def deliver_doctors_messages(message, numbered, nav_row, reply_keyboard):
+    """По сообщению на врача с кнопкой карточки под каждым"""
+    for idx, doc in numbered:
         keyboard = None
         if doc.get('link'):
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -806,24 +2996,18 @@ async def send_doctors_list(message, spec_slug, spec_name, keyboard_to_keep=None
                 )]
             ])
 
-        caption = (
-            f"<b>{idx}. {doc['name']}</b> (⭐ {doc['rating']})\n"
-            f"📅 Стаж: {doc['experience']}\n"
-            f"🏥 Клиника: {doc['clinic']}\n"
-            f"📍 Адрес: {doc['address']}\n"
-            f"💰 Приём: {doc['price']}\n"
-            f"📞 Телефон: {phone_text}"
-        )
+        caption = format_doctor_caption(idx, doc)
 
         try:
             if doc.get('photo'):
-                await bot.send_photo(
+                sent_message = await bot.send_photo(
                     message.chat.id, 
-                    photo=doc['photo'], 
+                    photo=photo_file_ids.get(doc['photo']) or doc['photo'], 
                     caption=caption, 
                     parse_mode="HTML",
                     reply_markup=keyboard
                 )
+                remember_photo(doc['photo'], sent_message)
             else:
                 await bot.send_message(
                     message.chat.id, 
@@ -843,48 +3027,299 @@ async def send_doctors_list(message, spec_slug, spec_name, keyboard_to_keep=None
             )
             await bot.send_message(message.chat.id, text=plain_text, reply_markup=keyboard)
 
-    if keyboard_to_keep:
-        await message.answer("✅ Готово! Нажмите на кнопку под каждым врачом для просмотра подробной информации.", reply_markup=keyboard_to_keep)
+    done_text = "✅ Готово! Нажмите на кнопку под каждым врачом для просмотра подробной информации."
+    nav_keyboard = InlineKeyboardMarkup(inline_keyboard=[nav_row]) if nav_row else None
+    if reply_keyboard:
+        await message.answer(done_text, reply_markup=reply_keyboard)
+        if nav_keyboard:
+            await message.answer("Показать других врачей:", reply_markup=nav_keyboard)
     else:
-        await message.answer("✅ Готово! Нажмите на кнопку под каждым врачом для просмотра подробной информации.", reply_markup=get_back_to_menu_keyboard())
+        await message.answer(done_text, reply_markup=nav_keyboard)
+
+# ------------------ ФОНОВЫЙ ПРОГРЕВ КЭША ------------------
+async def warm_doctors(city, spec_slug, semaphore):
+    async with semaphore:
+        # Разносим запросы во времени, чтобы не долбить сайт пачкой
+        await asyncio.sleep(random.uniform(0, WARMER_JITTER_SECONDS))
+        await refresh_doctors(city, spec_slug)
+
+def warm_candidates():
+    """Все специализации города по умолчанию и то, что недавно спрашивали в других городах"""
+    candidates = {(DEFAULT_CITY, slug) for slug in SPECIALIZATIONS.values()}
+    recent_after = time.monotonic() - WARMER_RECENT_HOURS * 3600
+    for key, requested_at in list(spec_last_requested.items()):
+        if requested_at < recent_after:
+            # Давно не спрашивали: забываем, чтобы счетчики не копились бесконечно
+            del spec_last_requested[key]
+            spec_requests.pop(key, None)
+            continue
+        city, spec_slug = key.split(":", 1)
+        candidates.add((city, spec_slug))
+    return candidates
 
-# ------------------ KEEP-ALIVE МЕХАНИЗМ ------------------
-async def keep_alive():
-    """Периодическая активность чтобы бот не 'засыпал'"""
+async def cache_warmer():
+    """Обновляем кэш всех специализаций до истечения, популярные — первыми"""
+    semaphore = asyncio.Semaphore(WARMER_CONCURRENCY)
     while True:
         try:
-            # Просто логируем что бот жив
-            logger.info("🤖 Бот активен...")
-            # Можно также периодически сохранять кэш или делать другую легкую работу
-            await asyncio.sleep(300)  # Каждые 5 минут
+            due = [(city, slug) for city, slug in warm_candidates() if await needs_refresh(city, slug)]
+            due.sort(key=lambda item: spec_requests[doctors_key(*item)], reverse=True)
+            if due:
+                logger.info(f"🔄 Прогрев кэша: {len(due)} специализаций")
+                await asyncio.gather(*(warm_doctors(city, slug, semaphore) for city, slug in due))
         except Exception as e:
-            logger.error(f"Ошибка в keep-alive: {e}")
-            await asyncio.sleep(60)
+            logger.error(f"Ошибка прогрева кэша: {e}")
+        await asyncio.sleep(WARMER_INTERVAL_SECONDS)
+
+# ------------------ МЕТРИКИ КОМПОНЕНТОВ ------------------
+def _cache_counts():
+    counts = {}
+    for name, cache in (("doctors", doctors_cache), ("llm", llm_cache), ("photo", photo_file_ids)):
+        counts[(("cache", name), ("result", "hit"))] = cache.hits
+        counts[(("cache", name), ("result", "miss"))] = cache.misses
+    return counts
+
+metrics.collector("bot_cache_requests_total", "Обращения к кэшам", "counter", _cache_counts)
+metrics.collector("bot_cache_entries", "Записей в памяти", "gauge", lambda: {
+    (("cache", "doctors"),): len(doctors_cache),
+    (("cache", "llm"),): len(llm_cache),
+    (("cache", "photo"),): len(photo_file_ids),
+})
+metrics.collector("bot_llm_events_total", "События клиента YandexGPT (запросы, ошибки, таймауты, отказы)", "counter",
+                  lambda: {(("event", event),): count for event, count in yandex_client.stats.items()})
+metrics.collector("bot_llm_breaker_open", "Circuit breaker YandexGPT разомкнут", "gauge",
+                  lambda: int(yandex_client.breaker.state != "closed"))
+metrics.collector("bot_llm_breaker_transitions_total", "Переходы circuit breaker YandexGPT по новому состоянию", "counter",
+                  lambda: {(("to", state),): count for state, count in yandex_client.breaker.transitions.items()})
+metrics.collector("bot_symptom_answers_total", "Ответы локального классификатора", "counter",
+                  lambda: {(("result", key),): count for key, count in symptom_classifier.stats.items()})
+metrics.collector("bot_interaction_log_dropped_total", "Записи лога, отброшенные при переполнении очереди", "counter",
+                  lambda: interaction_log.dropped)
+metrics.collector("bot_users", "Пользователей в базе", "gauge", lambda: len(user_store))
+
+def metrics_summary():
+    """Короткая сводка метрик для /stats"""
+    def ms(value):
+        return "—" if value is None else ("&gt;30 с" if value == float("inf") else f"{value * 1000:.0f} мс")
+
+    lines = ["⏱ Обработчики (p50 / p95, вызовов, ошибок):"]
+    for labels, (_, _, count) in sorted(handler_seconds.series.items(), key=lambda item: -item[1][2])[:8]:
+        name = dict(labels)["handler"]
+        lines.append(
+            f"  {name}: {ms(handler_seconds.quantile(0.5, handler=name))} / "
+            f"{ms(handler_seconds.quantile(0.95, handler=name))}, {count}, "
+            f"{handler_errors.values[labels]}"
+        )
+    lookups = doctors_cache.hits + doctors_cache.misses
+    hit_ratio = f"{doctors_cache.hits / lookups:.0%}" if lookups else "—"
+    lines.append(f"📦 Кэш врачей: попаданий {hit_ratio} из {lookups}")
+    lines.append(
+        f"🌐 Загрузка страницы p95: {ms(scrape_fetch_seconds.quantile(0.95))}, "
+        f"разбор p95: {ms(scrape_parse_seconds.quantile(0.95))} (+ ожидание пула {ms(scrape_parse_wait_seconds.quantile(0.95))}), "
+        f"ошибок {sum(scrape_errors.values.values())}"
+    )
+    llm_calls = sum(series[2] for series in llm_seconds.series.values())
+    lines.append(f"🧠 Запросов к YandexGPT: {llm_calls}, p95 {ms(llm_seconds.quantile(0.95, status='200'))}")
+    lines.append(
+        f"📨 Вызовов Bot API: {sum(telegram_calls.values.values())}, "
+        f"flood-wait: {sum(telegram_flood_waits.values.values())}"
+    )
+    return "\n".join(lines)
+
+_metrics_runner = None
+
+async def start_metrics_server():
+    global _metrics_runner
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    _metrics_runner = web.AppRunner(app, access_log=None)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
 
 # ------------------ ЗАПУСК ------------------
-async def main():
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Вебхук с ограничением числа апдейтов в обработке; сверх лимита отвечаем 503, Telegram повторит позже"""
+
+    def __init__(self, dispatcher, bot, max_in_flight, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def _handle_request_background(self, bot, request):
+        if self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            return web.Response(status=503, headers={"Retry-After": "1"}, text="Busy")
+        self.in_flight += 1
+        try:
+            return await super()._handle_request_background(bot=bot, request=request)
+        except Exception:
+            self.in_flight -= 1
+            raise
+
+    async def _background_feed_update(self, bot, update):
+        try:
+            await super()._background_feed_update(bot=bot, update=update)
+        finally:
+            self.in_flight -= 1
+
+_service_tasks = []
+
+async def ensure_webhook(bot: Bot):
+    """Ставим вебхук, только если он еще не наш. Ожидающие апдейты не сбрасываем: при перезапуске
+    или добавлении реплики Telegram повторит то, на что остальные ответили 503"""
+    url = f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}"
+    secret_hash = hashlib.sha256((WEBHOOK_SECRET or "").encode()).hexdigest()
+    info = await bot.get_webhook_info()
+    allowed_updates = dp.resolve_used_update_types()
+    # Секрет Telegram не возвращает, поэтому его отпечаток храним в общей базе
+    if (info.url == url and set(info.allowed_updates or ()) == set(allowed_updates)
+            and user_store.get_meta("webhook_secret") == secret_hash):
+        logger.info(f"Вебхук уже установлен: {url}")
+        return
+    await bot.set_webhook(
+        url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=allowed_updates,
+    )
+    user_store.set_meta("webhook_secret", secret_hash)
+    logger.info(f"Вебхук установлен: {url}")
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    """Открываем общие ресурсы и запускаем фоновые задачи (и для polling, и для webhook)"""
     # Диагностика при запуске
-    logger.info("🚀 Бот запущен...")
+    logger.info(f"🚀 Бот запущен ({BOT_MODE})...")
     logger.info(f"Текущая директория: {os.getcwd()}")
-    logger.info(f"Путь к файлу пользователей: {USERS_FILE}")
-    
-    # Проверяем доступность файлов
-    for file_path in [USERS_FILE, CACHE_FILE]:
-        try:
-            if not os.path.exists(file_path):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    initial_data = [] if 'users' in file_path else {}
-                    json.dump(initial_data, f, ensure_ascii=False)
-                logger.info(f"Создан файл: {file_path}")
-            else:
-                logger.info(f"Файл существует: {file_path} ({os.path.getsize(file_path)} байт)")
-        except Exception as e:
-            logger.error(f"Ошибка работы с файлом {file_path}: {e}")
-    
-    # Запускаем keep-alive в фоне
-    asyncio.create_task(keep_alive())
+    logger.info(f"Путь к базе пользователей: {USERS_DB}")
+    logger.info(f"Путь к кэшу врачей: {DOCTORS_DB}")
+
+    # Первым делом: воркеры разбора форкаются до потоков to_thread и соединений SQLite
+    await start_parser_pool()
+
+    user_store.open()
+    try:
+        imported = user_store.import_json(USERS_FILE)
+        if imported:
+            logger.info(f"Импортировано пользователей из {USERS_FILE}: {imported}")
+    except Exception as e:
+        logger.error(f"Ошибка импорта {USERS_FILE}: {e}")
+    logger.info(f"Пользователей в базе: {len(user_store)}")
+
+    # Веса локального классификатора берем из прошлых ответов YandexGPT
+    try:
+        pairs = await asyncio.to_thread(symptom_classifier.fit_from_logs, interaction_log, LEGACY_LOG_FILE)
+        logger.info(f"Классификатор симптомов: обучен на {pairs} ответах, основ {len(symptom_classifier.learned)}")
+    except Exception as e:
+        logger.error(f"Ошибка обучения классификатора: {e}")
     
-    await dp.start_polling(bot, skip_updates=True)
+    # Кэш врачей читается с диска по ключу при первом обращении, здесь только открываем базу
+    doctors_store.open()
+    try:
+        imported = doctors_store.import_json(CACHE_FILE, migrate=migrate_doctors_cache)
+        if imported:
+            logger.info(f"Импортировано записей кэша из {CACHE_FILE}: {imported}")
+    except Exception as e:
+        logger.error(f"Ошибка импорта {CACHE_FILE}: {e}")
+    logger.info(f"Кэш врачей на диске: {len(doctors_store)} записей")
+
+    # Остальные кэши читаем с диска один раз, дальше файлы только пополняются в фоне
+    for cache, path in PERSISTED_CACHES:
+        cache.load(load_cache(path))
+        logger.info(f"Кэш {path} загружен: {len(cache)} записей")
+
+    # Один пул соединений на все время работы бота
+    get_http_session()
+
+    # Клавиатуры, данные бота и file_id картинки /start (после загрузки photo_file_ids)
+    await precompute_static(bot)
+
+    try:
+        await start_metrics_server()
+    except OSError as e:
+        logger.error(f"Сервер метрик не запущен: {e}")
+
+    # Запускаем прогрев и запись кэша в фоне
+    _service_tasks.extend([
+        asyncio.create_task(cache_warmer()),
+        asyncio.create_task(cache_flusher()),
+        asyncio.create_task(resume_broadcasts()),
+        asyncio.create_task(fsm_cleaner()),
+        asyncio.create_task(interaction_log.run()),
+    ])
+
+    if BOT_MODE == "webhook":
+        await ensure_webhook(bot)
+
+@dp.shutdown()
+async def on_shutdown():
+    """Останавливаем фоновые задачи и сохраняем состояние"""
+    for task in _service_tasks:
+        task.cancel()
+    await asyncio.gather(*_service_tasks, return_exceptions=True)
+    _service_tasks.clear()
+    await interaction_log.flush()
+    try:
+        daily_stats.flush()
+    except Exception as e:
+        logger.error(f"Ошибка записи статистики: {e}")
+    await stop_metrics_server()
+    await flush_cache()
+    await close_http_session()
+    shutdown_parser_executor()
+    doctors_store.close()
+    user_store.close()
+    logger.info("🛑 Бот остановлен")
+
+async def handle_health(request: web.Request):
+    """Проверка живости для балансировщика"""
+    handler = request.app["webhook_handler"]
+    return web.json_response({
+        "status": "ok",
+        "mode": BOT_MODE,
+        "in_flight": handler.in_flight,
+        "rejected": handler.rejected,
+        "users": len(user_store),
+        "doctors_cache": len(doctors_cache),
+        "llm_breaker": yandex_client.breaker.state,
+    })
+
+def create_webhook_app():
+    """aiohttp-приложение: вебхук Telegram, health-check и хуки запуска/остановки диспетчера"""
+    app = web.Application()
+    handler = LimitedRequestHandler(dp, bot, WEBHOOK_MAX_IN_FLIGHT, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    app["webhook_handler"] = handler
+    app.router.add_get(HEALTH_PATH, handle_health)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Вебхук-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def main():
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,167 @@
+"""Разбор страниц списка врачей prodoctorov.ru.
+
+Чистые функции без настроек бота: модуль импортируется воркерами пула разбора
+и bench/bench_parser.py без BOT_TOKEN и прочих переменных окружения.
+"""
+import logging
+import re
+import time
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+logger = logging.getLogger(__name__)
+
+PRODOCTOROV_URL = "https://prodoctorov.ru"
+
+
+def get_parser_backend(preferred=None):
+    """Парсер для BeautifulSoup: указанный или самый быстрый доступный ("auto")"""
+    if preferred and preferred != "auto":
+        return preferred
+    try:
+        import lxml  # noqa: F401
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+
+def clean_phone(phone_text):
+    if not phone_text or not isinstance(phone_text, str):
+        return None
+    cleaned = re.sub(r'[^0-9+]', '', phone_text)
+    return cleaned if cleaned else None
+
+
+def _is_doctor_card(css_class):
+    # Во время разбора class приходит строкой "b-doctor-card b-doctor-card_..."
+    return bool(css_class) and "b-doctor-card" in css_class.split()
+
+
+# Строим дерево только для карточек врачей, остальная страница пропускается
+DOCTOR_CARDS_ONLY = SoupStrainer("div", class_=_is_doctor_card)
+
+
+def parse_doctors(html, max_count=None, backend=None, base_url=PRODOCTOROV_URL):
+    """Чистая функция: HTML страницы -> список врачей, отсортированный по рейтингу"""
+    soup = BeautifulSoup(html, get_parser_backend(backend), parse_only=DOCTOR_CARDS_ONLY)
+    cards = soup.select('div.b-doctor-card')
+    doctors = []
+
+    for i, card in enumerate(cards[:max_count]):
+        try:
+            name_elem = card.select_one('span.b-doctor-card__name-surname')
+            name = name_elem.get_text(strip=True) if name_elem else "Не указано"
+
+            doctor_link = None
+            link_selectors = [
+                'a.b-doctor-card__name',
+                'a[href*="/doctor/"]',
+                'a.b-doctor-card__link',
+            ]
+            
+            for selector in link_selectors:
+                link_elem = card.select_one(selector)
+                if link_elem and link_elem.get('href'):
+                    href = link_elem['href']
+                    if href.startswith('/'):
+                        doctor_link = base_url + href
+                    elif href.startswith('http'):
+                        doctor_link = href
+                    break
+            
+            if not doctor_link:
+                any_link = card.select_one('a[href]')
+                if any_link and any_link.get('href'):
+                    href = any_link['href']
+                    if href.startswith('/'):
+                        doctor_link = base_url + href
+                    elif href.startswith('http'):
+                        doctor_link = href
+
+            rating_elem = card.select_one('div.b-stars-rate__progress')
+            rating = "0.0"
+            if rating_elem and rating_elem.get('style'):
+                try:
+                    width_str = rating_elem['style'].replace('width:', '').replace('em', '').strip()
+                    rating = f"{round(float(width_str) / 1.28, 1)}"
+                except:
+                    pass
+
+            photo_elem = card.select_one('img.b-profile-card__img')
+            photo = None
+            if photo_elem and photo_elem.get('src'):
+                photo_url = photo_elem['src']
+                photo = photo_url if photo_url.startswith('http') else base_url + photo_url
+
+            experience_elem = card.select_one('div.b-doctor-card__experience .ui-text_subtitle-1')
+            experience = experience_elem.get_text(strip=True) if experience_elem else "Не указан"
+
+            clinic = "Не указана"
+            address = "Не указан"
+            clinic_container = card.select_one('div.b-doctor-card__lpu-select')
+            if clinic_container:
+                clinic_elem = clinic_container.select_one('span.b-select__trigger-main-text')
+                address_elem = clinic_container.select_one('span.b-select__trigger-adit-text')
+                clinic = clinic_elem.get_text(strip=True) if clinic_elem else "Не указана"
+                address = address_elem.get_text(strip=True) if address_elem else "Не указан"
+
+            price = "Не указана"
+            price_elems = [
+                '.b-doctor-card__price .ui-text_subtitle-1',
+                '.b-doctor-card__tabs-wrapper_club fieldset .ui-text_subtitle-1',
+            ]
+            for selector in price_elems:
+                price_elem = card.select_one(selector)
+                if price_elem and price_elem.get_text(strip=True):
+                    price = price_elem.get_text(strip=True).replace(u'\xa0', ' ')
+                    break
+
+            phone = "Не указан"
+            phone_clean = None
+            phone_elems = [
+                '.b-doctor-card__lpu-phone-container .b-doctor-card__lpu-phone',
+                '.b-doctor-card__phone .ui-text_subtitle-1',
+            ]
+            for selector in phone_elems:
+                phone_elem = card.select_one(selector)
+                if phone_elem and phone_elem.get_text(strip=True):
+                    phone = phone_elem.get_text(strip=True)
+                    phone_clean = clean_phone(phone)
+                    break
+
+            doctors.append({
+                'name': name,
+                'link': doctor_link,
+                'rating': rating,
+                'photo': photo,
+                'experience': experience,
+                'clinic': clinic,
+                'address': address,
+                'price': price,
+                'phone': phone,
+                'phone_clean': phone_clean
+            })
+
+        except Exception as e:
+            logger.error(f"Ошибка парсинга карточки {i}: {e}")
+            continue
+
+    doctors.sort(key=lambda x: float(x['rating']), reverse=True)
+    return doctors
+
+
+def parse_page_count(html):
+    """Число страниц списка по ссылкам пагинации (?page=N)"""
+    return max((int(n) for n in re.findall(r'[?&]page=(\d+)', html)), default=1)
+
+
+def parse_listing(html, backend=None, base_url=PRODOCTOROV_URL):
+    """Врачи со страницы списка и общее число страниц"""
+    return parse_doctors(html, backend=backend, base_url=base_url), parse_page_count(html)
+
+
+def parse_listing_timed(html, backend=None, base_url=PRODOCTOROV_URL):
+    """parse_listing и время разбора: метрики воркера пула процессов до бота не доходят"""
+    started = time.perf_counter()
+    result = parse_listing(html, backend, base_url)
+    return result, time.perf_counter() - started